@@ -13,3 +13,14 @@ class UIFormAdmin(admin.ModelAdmin):
 admin.site.register(UIForm, UIFormAdmin)
 admin.site.register(URLToken)
 
+class QueuedEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'recipients', 'created', 'attempts', 'sent',
+            'failed')
+    list_filter = ('failed',)
+
+admin.site.register(QueuedEmail, QueuedEmailAdmin)
+
+class PendingNotificationAdmin(admin.ModelAdmin):
+    list_display = ('uiform', 'created')
+
+admin.site.register(PendingNotification, PendingNotificationAdmin)
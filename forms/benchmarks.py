@@ -0,0 +1,145 @@
+"""
+Micro-benchmarks for the hot paths of the forms app.
+
+Run them with the run_benchmarks management command, which creates the
+fixture data in a throwaway test database.
+"""
+from django.template import Template, Context
+from django.contrib.auth.models import User
+from timeit import Timer
+
+from models import UIForm, UIField
+from serializers import UIFormData
+import serializers
+
+# Registered benchmarks, as (name, setup) pairs in the order they run. setup
+# is called with the fixture and returns the function to time.
+BENCHMARKS = []
+
+def benchmark(setup):
+    BENCHMARKS.append((setup.__name__, setup))
+    return setup
+
+
+def create_fixture(fields=20):
+    """
+    Creates a user and a published UIForm with the given number of UIFields.
+    """
+    user = User.objects.create_user('benchmark', 'benchmark@example.com',
+            'benchmark')
+    uiform = UIForm.objects.create(label='Benchmark UIForm',
+            description='A form with "quotes"\nand newlines', creator=user)
+    for i in range(fields):
+        UIField.objects.create(uiform=uiform, label='Question %d' % i,
+                kind='BI'[i % 2], description='Help text %d' % i)
+    uiform = UIForm.objects.get(id=uiform.id)
+    # Token pages 404 until a form is published
+    uiform.publish()
+    return uiform
+
+
+def fixture_answers(uiform):
+    """
+    Returns POST data that fills in every field of a UIForm's PreviewForm.
+    """
+    data = {}
+    for field in uiform.get_preview_form().compiled_fields:
+        if field.kind.code == 'B':
+            data[field.name] = 'on'
+        else:
+            data[field.name] = '42'
+    return data
+
+
+def percentile(values, fraction):
+    """ Returns the value at a fraction (0-1) of the way through values """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def compare(results, baseline):
+    """
+    Returns {name: ratio} of each benchmark's best time to the baseline's,
+    for benchmarks in both. A ratio above 1 is a slowdown.
+    """
+    return dict((name, result['best_us'] / baseline[name]['best_us'])
+            for name, result in results.items()
+            if name in baseline and baseline[name]['best_us'])
+
+
+def run(setup, fixture, number=1000, repeat=3):
+    """
+    Times a benchmark, returning a dict of timings in microseconds per call.
+    """
+    timer = Timer(setup(fixture))
+    timings = [t / number * 1e6 for t in timer.repeat(repeat, number)]
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best_us': min(timings),
+        'mean_us': sum(timings) / len(timings),
+    }
+
+
+# The uiform.json template that status_uiform used to render
+STATUS_TEMPLATE = Template('''{
+    "id": {{ uiform.id }}, 
+    "slug": "{{ uiform.slug }}", 
+    "label": "{{ uiform.label }}",
+    "description": "{{ uiform.description }}",
+    "creator": "{{ uiform.creator }}",
+    "last_updated": {{ uiform.last_updated|date:"U" }},
+    "url": "{% url preview_uiform uiform.slug %}"
+}''')
+
+@benchmark
+def status_json_template(uiform):
+    def call():
+        STATUS_TEMPLATE.render(Context({'uiform': uiform}))
+    return call
+
+@benchmark
+def status_json_serializer(uiform):
+    creator = uiform.creator.username
+    def call():
+        serializers.dumps(UIFormData.from_model(uiform, creator))
+    return call
+
+
+@benchmark
+def preview_form_unbound(uiform):
+    def call():
+        uiform.get_preview_form()
+    return call
+
+@benchmark
+def preview_form_validate(uiform):
+    data = fixture_answers(uiform)
+    def call():
+        uiform.get_preview_form(data).is_valid()
+    return call
+
+@benchmark
+def preview_form_compiled_validate(uiform):
+    data = fixture_answers(uiform)
+    form_class = uiform.get_preview_form().__class__
+    def call():
+        form_class.validate(data)
+    return call
+
+@benchmark
+def preview_form_get_results(uiform):
+    form = uiform.get_preview_form(fixture_answers(uiform))
+    form.is_valid()
+    def call():
+        form.get_results()
+    return call
+
+@benchmark
+def field_formset(uiform):
+    def call():
+        # Iterating builds the forms, which runs the UIField query
+        list(uiform.get_field_formset().forms)
+    return call
@@ -0,0 +1,374 @@
+"""
+Buffers validated submissions to shared forms and stores them in batches.
+
+With UIFORMS_INGEST_ENABLED set, view_token_uiform hands each valid
+submission to the ingester instead of storing it and queueing its email
+inline. A flusher thread in each process stores everything buffered every
+UIFORMS_INGEST_FLUSH_INTERVAL seconds, or as soon as
+UIFORMS_INGEST_BATCH_SIZE submissions are waiting, with multi-row INSERTs in
+a single transaction, and then notifies the creators.
+
+The buffer holds at most UIFORMS_INGEST_QUEUE_SIZE submissions. When it's
+full, submit() waits up to UIFORMS_INGEST_PUT_TIMEOUT seconds for the
+flusher and then raises IngestFull, so a slow database pushes back on
+visitors instead of growing the buffer without limit.
+
+If UIFORMS_INGEST_SPOOL_DIR is set, each submission is also appended to a
+spool file there before submit() returns, and the file is only removed once
+its submissions are committed. Spool files left by a process that died are
+stored when the next flusher starts, or by the flush_submission_spool
+command. Each file is locked by the process that owns it, so several
+processes can share the directory. Set UIFORMS_INGEST_FSYNC to survive the
+machine crashing too, at the cost of an fsync per submission. A crash after
+a commit and before the spool file is removed stores those submissions
+again.
+
+Submissions that can't be stored, because their UIForm has been deleted or
+they've failed UIFORMS_INGEST_MAX_ATTEMPTS times, are dropped so they can't
+hold up the rest. They're logged, and appended to REJECTED_NAME in the spool
+directory, from where "flush_submission_spool --retry-rejected" can try
+them again.
+"""
+from __future__ import with_statement
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+from datetime import datetime
+from uuid import uuid4
+import threading
+import logging
+import atexit
+import fcntl
+import time
+import os
+
+from models import UIForm, Submission, SchemaVersion, get_schema_version, \
+        parse_timestamp
+from utils import notify_completed
+
+log = logging.getLogger(__name__)
+
+ENABLED = getattr(settings, 'UIFORMS_INGEST_ENABLED', False)
+
+# Most submissions buffered in each process
+QUEUE_SIZE = getattr(settings, 'UIFORMS_INGEST_QUEUE_SIZE', 10000)
+
+# Buffered submissions that trigger a flush before the interval is up
+BATCH_SIZE = getattr(settings, 'UIFORMS_INGEST_BATCH_SIZE', 500)
+
+# Longest a submission waits in the buffer, in seconds
+FLUSH_INTERVAL = getattr(settings, 'UIFORMS_INGEST_FLUSH_INTERVAL', 1.0)
+
+# Seconds submit() waits for room in a full buffer
+PUT_TIMEOUT = getattr(settings, 'UIFORMS_INGEST_PUT_TIMEOUT', 0.5)
+
+# Flushes a submission can fail in before it's rejected
+MAX_ATTEMPTS = getattr(settings, 'UIFORMS_INGEST_MAX_ATTEMPTS', 10)
+
+SPOOL_DIR = getattr(settings, 'UIFORMS_INGEST_SPOOL_DIR', None)
+FSYNC = getattr(settings, 'UIFORMS_INGEST_FSYNC', False)
+
+SPOOL_SUFFIX = '.jsonl'
+REJECTED_NAME = 'rejected.log'
+
+
+class IngestFull(Exception):
+    pass
+
+
+def store_entries(entries):
+    """
+    Stores a list of (SchemaVersion id, submitted, answers) entries in one
+    transaction, then notifies the creators. Entries whose SchemaVersion or
+    UIForm has been deleted, or whose answers don't fit their version, are
+    left out and returned.
+    """
+    versions = {}
+    for version_id in set(entry[0] for entry in entries):
+        try:
+            versions[version_id] = get_schema_version(version_id)
+        except SchemaVersion.DoesNotExist:
+            pass
+    # Versions cached by other processes outlive their deleted UIForms, so
+    # check the UIForms are still there
+    uiforms = UIForm.objects.select_related('creator').in_bulk(
+            [version.uiform_id for version in versions.values()])
+
+    batch, rejected = [], []
+    for version_id, submitted, answers in entries:
+        version = versions.get(version_id)
+        try:
+            if version is None or version.uiform_id not in uiforms:
+                raise ValueError('SchemaVersion %d was deleted' % version_id)
+            version.get_form_class().measure(answers)
+        except Exception, e:
+            log.warning('Rejected a submission to SchemaVersion %d: %s',
+                    version_id, e)
+            rejected.append((version_id, submitted, answers))
+        else:
+            batch.append((version, submitted, answers))
+
+    if batch:
+        Submission.objects.record_batch(batch)
+    for version, submitted, answers in batch:
+        # Already committed, so a failure here mustn't fail the batch
+        try:
+            notify_completed(None, uiforms[version.uiform_id],
+                    version.get_form_class().describe(answers))
+        except Exception:
+            log.exception('Notifying the creator of %s failed',
+                    uiforms[version.uiform_id])
+    return rejected
+
+def reject_entries(entries, spool_dir):
+    """
+    Logs entries that can't be stored, and appends them to REJECTED_NAME in
+    spool_dir, if there is one.
+    """
+    if not entries:
+        return
+    log.error('Dropped %d submissions that could not be stored', len(entries))
+    if spool_dir:
+        file = open(os.path.join(spool_dir, REJECTED_NAME), 'a')
+        try:
+            file.write(''.join(dump_entry(*entry) for entry in entries))
+        finally:
+            file.close()
+
+
+def dump_entry(version_id, submitted, answers):
+    return simplejson.dumps({
+        'version': version_id,
+        'submitted': submitted.isoformat(),
+        'answers': answers,
+    }, separators=(',', ':')) + '\n'
+
+def load_entry(line):
+    """ Returns the entry for a spool file line. Raises ValueError """
+    data = simplejson.loads(line)
+    return (int(data['version']), parse_timestamp(data['submitted']),
+            dict((int(id), answer) for id, answer in data['answers'].items()))
+
+
+def lock_file(file):
+    """ Locks an open file, returning False if another process has it """
+    try:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        return False
+    return True
+
+def recover_spool(spool_dir):
+    """
+    Stores the submissions in spool files that no running process owns, and
+    removes the files. Returns the number of submissions stored.
+    """
+    stored = 0
+    for name in sorted(os.listdir(spool_dir)):
+        if not name.endswith(SPOOL_SUFFIX):
+            continue
+        path = os.path.join(spool_dir, name)
+        try:
+            file = open(path, 'r+')
+        except IOError:
+            # Removed by another process since listing
+            continue
+        try:
+            if not lock_file(file) or not os.path.exists(path):
+                continue
+            entries = []
+            for number, line in enumerate(file):
+                try:
+                    entries.append(load_entry(line))
+                except (ValueError, KeyError, TypeError):
+                    # Usually the last line, cut short by a crash
+                    log.warning('Skipped bad line %d of %s', number + 1, path)
+            try:
+                rejected = store_entries(entries)
+            except Exception:
+                # Store them one at a time, so one bad entry can't fail them
+                # all
+                connection.close()
+                rejected, failed = [], []
+                for entry in entries:
+                    try:
+                        rejected.extend(store_entries([entry]))
+                    except Exception:
+                        connection.close()
+                        failed.append(entry)
+                if entries and len(failed) == len(entries):
+                    # Most likely the database, so keep the file for later
+                    log.error('Could not store any submissions from %s', path)
+                    continue
+                rejected.extend(failed)
+            reject_entries(rejected, spool_dir)
+            stored += len(entries) - len(rejected)
+            os.remove(path)
+        finally:
+            file.close()
+    return stored
+
+
+class SubmissionIngester(object):
+    def __init__(self, enabled, queue_size, batch_size, interval, put_timeout,
+            spool_dir=None, fsync=False, max_attempts=MAX_ATTEMPTS):
+        self.enabled = enabled
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.interval = interval
+        self.put_timeout = put_timeout
+        self.spool_dir = spool_dir
+        self.fsync = fsync
+        self.max_attempts = max_attempts
+
+        self.condition = threading.Condition()
+        self.entries = []
+        # The (file, path) being appended to, and the spool files whose
+        # submissions have been taken by the flusher but may not be
+        # committed yet
+        self.spool = None
+        self.pending = []
+        # Held while flushing, so one flush can't remove another's spool
+        # files before they're committed
+        self.flushing = threading.Lock()
+        # (entry, failed attempts) pairs to store again in the next flush.
+        # Only used while flushing.
+        self.retries = []
+        self.thread = None
+        self.stopping = False
+
+    def submit(self, version, answers):
+        """
+        Buffers validated answers to a SchemaVersion, to be stored by the
+        flusher. Raises IngestFull if there's no room within put_timeout.
+        """
+        entry = (version.id, datetime.now(), answers)
+        with self.condition:
+            self.start()
+            deadline = time.time() + self.put_timeout
+            while len(self.entries) >= self.queue_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise IngestFull('%d submissions waiting' %
+                            len(self.entries))
+                self.condition.wait(remaining)
+
+            if self.spool_dir:
+                self.write_spool(entry)
+            self.entries.append(entry)
+            if len(self.entries) >= self.batch_size:
+                self.condition.notify_all()
+
+    def write_spool(self, entry):
+        if self.spool is None:
+            # Lock the file before giving it the name recover_spool() looks
+            # for, so no other process can take it
+            path = os.path.join(self.spool_dir, uuid4().hex)
+            file = open(path + '.new', 'a')
+            lock_file(file)
+            os.rename(path + '.new', path + SPOOL_SUFFIX)
+            self.spool = (file, path + SPOOL_SUFFIX)
+
+        file = self.spool[0]
+        file.write(dump_entry(*entry))
+        file.flush()
+        if self.fsync:
+            os.fsync(file.fileno())
+
+    def start(self):
+        """ Starts the flusher thread if it isn't running. Needs the lock. """
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run,
+                    name='submission-flusher')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def take(self):
+        """
+        Returns the buffered entries and the spool files holding them, and
+        starts a new spool file. Needs the lock.
+        """
+        entries, self.entries = self.entries, []
+        if self.spool is not None:
+            self.pending.append(self.spool)
+            self.spool = None
+        self.condition.notify_all()
+        return entries, list(self.pending)
+
+    def flush(self):
+        """
+        Stores everything buffered so far, and anything that failed to store
+        last time. Returns the number of submissions stored.
+        """
+        with self.flushing:
+            with self.condition:
+                entries, spools = self.take()
+            batch = self.retries + [(entry, 0) for entry in entries]
+            self.retries = []
+
+            rejected = []
+            if batch:
+                try:
+                    rejected = store_entries([entry for entry, attempts
+                        in batch])
+                except Exception:
+                    log.exception('Storing %d submissions failed', len(batch))
+                    connection.close()
+                    # Store them one at a time, so one bad entry can't hold
+                    # up the rest, and give up on those that keep failing
+                    rejected = []
+                    for entry, attempts in batch:
+                        try:
+                            rejected.extend(store_entries([entry]))
+                        except Exception:
+                            connection.close()
+                            if attempts + 1 >= self.max_attempts:
+                                rejected.append(entry)
+                            else:
+                                self.retries.append((entry, attempts + 1))
+                reject_entries(rejected, self.spool_dir)
+
+            if not self.retries:
+                # Every entry in these files has been stored or rejected
+                with self.condition:
+                    for spool in spools:
+                        file, path = spool
+                        os.remove(path)
+                        file.close()
+                        self.pending.remove(spool)
+            return len(batch) - len(rejected) - len(self.retries)
+
+    def run(self):
+        if self.spool_dir:
+            try:
+                recover_spool(self.spool_dir)
+            except Exception:
+                log.exception('Recovering the submission spool failed')
+
+        while not self.stopping:
+            with self.condition:
+                if len(self.entries) < self.batch_size:
+                    self.condition.wait(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Flushing submissions failed')
+            if self.retries:
+                time.sleep(self.interval)
+
+    def stop(self):
+        """ Stops the flusher after storing anything still buffered """
+        self.stopping = True
+        if self.thread is not None:
+            with self.condition:
+                self.condition.notify_all()
+            self.thread.join()
+            self.thread = None
+        self.flush()
+        self.stopping = False
+
+
+ingester = SubmissionIngester(ENABLED, QUEUE_SIZE, BATCH_SIZE, FLUSH_INTERVAL,
+        PUT_TIMEOUT, SPOOL_DIR, FSYNC, MAX_ATTEMPTS)
+
+atexit.register(ingester.stop)
@@ -0,0 +1,293 @@
+"""
+The kinds of UIField, keyed by the code stored in UIField.kind.
+
+Each kind parses answers with a form field and renders them with a widget
+that are created once and shared by every UIField of that kind. Per-field
+options (choices and bounds) are compiled into a validator when a UIForm's
+PreviewForm class is built, so checking a submission is a single pass over a
+table of validators rather than building Django form fields per request.
+
+Validated answers are already in the form they're stored in as JSON: dates
+are ISO strings and decimals are strings, so no precision is lost.
+"""
+from django import forms
+from django.core.exceptions import ValidationError
+from django.core.validators import EMPTY_VALUES
+from django.conf import settings
+from datetime import date, datetime
+
+# Width of the histogram buckets kept for Integer and Range fields
+HISTOGRAM_BUCKET_WIDTH = getattr(settings, 'UIFORMS_HISTOGRAM_BUCKET_WIDTH', 10)
+
+# Longest answer accepted by a Text field
+TEXT_MAX_LENGTH = getattr(settings, 'UIFORMS_TEXT_MAX_LENGTH', 1000)
+
+REQUIRED = forms.Field.default_error_messages['required']
+
+def histogram_bucket(value):
+    """ Returns the start of the histogram bucket containing value """
+    return value - value % HISTOGRAM_BUCKET_WIDTH
+
+def split_choices(text):
+    """ Returns the non-blank lines of UIField.choices """
+    return [line.strip() for line in (text or '').splitlines() if line.strip()]
+
+
+class CompiledField(forms.Field):
+    """
+    A form field that cleans its value with a compiled validator, so a bound
+    PreviewForm and PreviewForm.validate() always agree.
+    """
+    def __init__(self, validator, **kw):
+        self.validator = validator
+        super(CompiledField, self).__init__(**kw)
+
+    def clean(self, value):
+        return self.validator(value)
+
+
+class FieldKind(object):
+    """
+    Base class for UIField kinds. Subclasses set code and name, and usually
+    parser, a shared form field whose clean() converts a non-empty answer.
+    """
+    code = None
+    name = None
+    required = True
+    # Answer used for an empty value when the field isn't required
+    empty = None
+    parser = None
+    widget = forms.TextInput()
+
+    def check_options(self, choices, minimum, maximum):
+        """ Raises ValidationError if a UIField's options don't suit the kind """
+        pass
+
+    def parse(self, value):
+        """ Returns the stored answer for a non-empty value """
+        return self.parser.clean(value)
+
+    def compile(self, choices, minimum, maximum):
+        """
+        Returns a function that converts a submitted value to the stored
+        answer, or raises ValidationError.
+        """
+        parse, required, empty = self.parse, self.required, self.empty
+        def validate(value):
+            if value in EMPTY_VALUES:
+                if required:
+                    raise ValidationError(REQUIRED)
+                return empty
+            return parse(value)
+        return validate
+
+    def get_widget(self, choices):
+        return self.widget
+
+    def measure(self, answer, choices):
+        """
+        Returns a (value, bucket) pair for adding a stored answer to the
+        FieldAggregates. value is added to the total, minimum and maximum,
+        and bucket is the start of the histogram bucket to count it in. Either
+        can be None, in which case the answer is only counted.
+        """
+        return None, None
+
+    def get_stats(self, aggregate, histogram, choices):
+        """ Returns the kind-specific statistics for a FieldAggregate """
+        return {}
+
+
+class BooleanKind(FieldKind):
+    code, name = 'B', 'Boolean'
+    required = False
+    empty = False
+    widget = forms.CheckboxInput()
+    true_values = ('1', 'true', 'on', 'yes')
+    false_values = ('0', 'false', 'off', 'no')
+
+    def parse(self, value):
+        if isinstance(value, bool):
+            return value
+        value = unicode(value).strip().lower()
+        if value in self.true_values:
+            return True
+        if value in self.false_values:
+            return False
+        raise ValidationError('Enter true or false.')
+
+    def measure(self, answer, choices):
+        return int(answer), None
+
+    def get_stats(self, aggregate, histogram, choices):
+        return {
+            'true': aggregate.total,
+            'false': aggregate.count - aggregate.total,
+        }
+
+
+class IntegerKind(FieldKind):
+    code, name = 'I', 'Integer'
+    parser = forms.IntegerField(required=False)
+
+    def measure(self, answer, choices):
+        return answer, histogram_bucket(answer)
+
+    def get_stats(self, aggregate, histogram, choices):
+        return {
+            'sum': aggregate.total,
+            'min': aggregate.minimum,
+            'max': aggregate.maximum,
+            'mean': aggregate.get_mean(),
+            'histogram': histogram,
+        }
+
+
+class RangeKind(IntegerKind):
+    """ An Integer between the UIField's minimum and maximum, inclusive """
+    code, name = 'R', 'Range'
+
+    def check_options(self, choices, minimum, maximum):
+        if minimum is None or maximum is None:
+            raise ValidationError('Range fields need a minimum and a maximum.')
+        if minimum > maximum:
+            raise ValidationError('The minimum must not be above the maximum.')
+
+    def compile(self, choices, minimum, maximum):
+        validate = super(RangeKind, self).compile(choices, minimum, maximum)
+        # check_options() refuses a missing bound, but fields saved without
+        # it are left open on that side rather than failing every page
+        if minimum is None and maximum is None:
+            return validate
+        elif maximum is None:
+            message = 'Enter a whole number of at least %d.' % minimum
+        elif minimum is None:
+            message = 'Enter a whole number of at most %d.' % maximum
+        else:
+            message = 'Enter a whole number from %d to %d.' % (minimum,
+                    maximum)
+        def validate_range(value):
+            answer = validate(value)
+            if answer is not None and ((minimum is not None and
+                    answer < minimum) or (maximum is not None and
+                    answer > maximum)):
+                raise ValidationError(message)
+            return answer
+        return validate_range
+
+
+class TextKind(FieldKind):
+    code, name = 'T', 'Text'
+    parser = forms.CharField(required=False, max_length=TEXT_MAX_LENGTH)
+
+
+class ChoiceKind(FieldKind):
+    code, name = 'C', 'Choice'
+    parser = forms.CharField(required=False)
+
+    def check_options(self, choices, minimum, maximum):
+        if not choices:
+            raise ValidationError('Choice fields need at least one choice.')
+
+    def compile(self, choices, minimum, maximum):
+        validate = super(ChoiceKind, self).compile(choices, minimum, maximum)
+        allowed = frozenset(choices)
+        def validate_choice(value):
+            answer = validate(value)
+            if answer is not None and answer not in allowed:
+                raise ValidationError('Select one of the available choices.')
+            return answer
+        return validate_choice
+
+    def get_widget(self, choices):
+        # The options differ per UIField, so each gets its own widget
+        return forms.Select(choices=[('', '---------')] +
+                [(choice, choice) for choice in choices])
+
+    def measure(self, answer, choices):
+        # Count each choice in the histogram bucket of its position
+        try:
+            return None, choices.index(answer)
+        except ValueError:
+            return None, None
+
+    def get_stats(self, aggregate, histogram, choices):
+        counts = dict(histogram)
+        return {
+            'choices': [[choice, counts.get(index, 0)]
+                for index, choice in enumerate(choices)],
+        }
+
+
+class DateKind(FieldKind):
+    code, name = 'D', 'Date'
+    parser = forms.DateField(required=False)
+    widget = forms.DateInput()
+
+    def parse(self, value):
+        return self.parser.clean(value).isoformat()
+
+    def measure(self, answer, choices):
+        return datetime.strptime(answer, '%Y-%m-%d').toordinal(), None
+
+    def get_stats(self, aggregate, histogram, choices):
+        return {
+            'min': aggregate.minimum and
+                date.fromordinal(aggregate.minimum).isoformat(),
+            'max': aggregate.maximum and
+                date.fromordinal(aggregate.maximum).isoformat(),
+        }
+
+
+class DecimalKind(FieldKind):
+    code, name = 'N', 'Decimal'
+    parser = forms.DecimalField(required=False)
+
+    def parse(self, value):
+        return str(self.parser.clean(value))
+
+
+# Registered kinds, in the order they're offered
+KINDS = (BooleanKind(), IntegerKind(), RangeKind(), TextKind(), ChoiceKind(),
+        DateKind(), DecimalKind())
+
+_kinds = dict((kind.code, kind) for kind in KINDS)
+
+def get_kind(code):
+    """ Returns the registered FieldKind with a code, or None """
+    return _kinds.get(code)
+
+def kind_choices():
+    """ Returns the choices for UIField.kind """
+    return tuple((kind.code, kind.name) for kind in KINDS)
+
+
+class CompiledUIField(object):
+    """
+    A UIField's name in its PreviewForm, its kind and its compiled validator.
+    """
+    __slots__ = ('id', 'name', 'kind', 'choices', 'validate')
+
+    def __init__(self, id, kind, choices, minimum, maximum):
+        self.id = id
+        self.name = 'uifield_%d_question' % id
+        self.kind = _kinds[kind]
+        self.choices = choices
+        self.validate = self.kind.compile(choices, minimum, maximum)
+
+    def measure(self, answer):
+        return self.kind.measure(answer, self.choices)
+
+    def form_field(self, label, description):
+        return CompiledField(self.validate, label=label, help_text=description,
+                required=self.kind.required,
+                widget=self.kind.get_widget(self.choices))
+
+
+def compile_uifield(id, kind, choices, minimum, maximum):
+    """
+    Returns a CompiledUIField, or None if the kind isn't registered.
+    """
+    if kind not in _kinds:
+        return None
+    return CompiledUIField(id, kind, choices, minimum, maximum)
@@ -0,0 +1,296 @@
+"""
+In-process load driver for the forms app.
+
+Replays a weighted mix of visitor submissions, token page views, previews
+and status checks through the Django test client, and reports throughput
+and latency percentiles. Run it with the run_loadtest management command,
+which points the app at a throwaway test database first.
+
+CreateRace posts to create_uiform from many threads at once, to check that
+concurrent creates of forms with the same slug all get distinct slugs. Run
+it with the run_create_race management command.
+
+SubmitThroughput posts submissions to a shared form from many threads,
+storing them inline or through the ingester, to compare their throughput.
+Run it with the run_ingest_benchmark management command.
+"""
+from __future__ import with_statement
+from django.test.client import Client
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Count
+from contextlib import contextmanager
+import threading
+import tempfile
+import random
+import time
+import os
+
+from models import URLToken, UIForm, Submission
+from benchmarks import create_fixture, fixture_answers, percentile
+from ingest import ingester
+
+
+@contextmanager
+def threaded_test_database():
+    """
+    Points the default database at a new test database for the duration of
+    a with block, and destroys it afterwards. Threads each have their own
+    connection, so an in-memory SQLite database is swapped for a temporary
+    file that they can share.
+    """
+    temp_name = None
+    settings_dict = connection.settings_dict
+    if (settings_dict['ENGINE'].endswith('sqlite3') and
+            settings_dict.get('TEST_NAME') in (None, '', ':memory:')):
+        fd, temp_name = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        settings_dict['TEST_NAME'] = temp_name
+
+    old_name = settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0,
+            autoclobber=bool(temp_name))
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        if temp_name:
+            settings_dict['TEST_NAME'] = None
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+
+# Default traffic mix, as relative weights
+MIX = {
+    'submit': 40,
+    'view': 30,
+    'preview': 15,
+    'status': 15,
+}
+
+
+def parse_mix(value):
+    """ Parses a mix like "submit=60,status=40" into a dict of weights """
+    mix = {}
+    for part in value.split(','):
+        kind, weight = part.split('=')
+        if kind not in MIX:
+            raise ValueError('Unknown request kind %s' % kind)
+        mix[kind] = int(weight)
+    return mix
+
+
+class LoadDriver(object):
+    def __init__(self, fields=20, seed=None):
+        self.uiform = create_fixture(fields)
+        self.token_url = URLToken.objects.create(
+                uiform=self.uiform).get_absolute_url()
+        self.answers = fixture_answers(self.uiform)
+        self.random = random.Random(seed)
+
+        self.visitor = Client()
+        self.creator = Client()
+        self.creator.login(username='benchmark', password='benchmark')
+
+    def request(self, kind, n):
+        uiform = self.uiform
+        if kind == 'submit':
+            # Vary the client address so the rate limiter lets it through
+            return self.visitor.post(self.token_url, self.answers,
+                    REMOTE_ADDR='10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255,
+                        n & 255))
+        elif kind == 'view':
+            return self.visitor.get(self.token_url)
+        elif kind == 'preview':
+            return self.creator.get('/forms/%s/preview/' % uiform.slug)
+        else:
+            return self.creator.get('/forms/%d/status/' % uiform.id)
+
+    def run(self, requests, mix=MIX):
+        """
+        Sends the given number of requests, choosing each kind at random by
+        weight, and returns a dict of results.
+        """
+        kinds = []
+        for kind, weight in mix.items():
+            kinds.extend([kind] * weight)
+
+        timings = dict((kind, []) for kind in mix)
+        errors = dict((kind, 0) for kind in mix)
+        start = time.time()
+        for n in xrange(requests):
+            kind = self.random.choice(kinds)
+            request_start = time.time()
+            response = self.request(kind, n)
+            timings[kind].append((time.time() - request_start) * 1000)
+            if response.status_code >= 400:
+                errors[kind] += 1
+        elapsed = time.time() - start
+
+        results = {
+            'requests': requests,
+            'elapsed_s': elapsed,
+            'throughput_rps': requests / elapsed,
+            'kinds': {},
+        }
+        for kind, values in timings.items():
+            if values:
+                results['kinds'][kind] = {
+                    'count': len(values),
+                    'errors': errors[kind],
+                    'mean_ms': sum(values) / len(values),
+                    'p50_ms': percentile(values, 0.5),
+                    'p99_ms': percentile(values, 0.99),
+                }
+        return results
+
+
+# Appended to the race label to make each label different without changing
+# its slug
+RACE_PUNCTUATION = '!?.,;:*()~'
+
+class CreateRace(object):
+    def __init__(self, label='Race'):
+        self.label = label
+        self.user = User.objects.create_user('race', 'race@example.com',
+                'race')
+
+    def get_label(self, n):
+        return self.label + ''.join(RACE_PUNCTUATION[int(digit)]
+                for digit in str(n))
+
+    def run(self, threads=8, requests=200):
+        """
+        Creates the given number of UIForms from a pool of threads, each
+        with its own client and database connection, using labels that all
+        have the same slug. Returns a dict of results.
+        """
+        numbers = iter(xrange(requests))
+        lock = threading.Lock()
+        statuses, errors, timings = {}, [], []
+
+        def worker():
+            client = Client()
+            client.login(username='race', password='race')
+            try:
+                while True:
+                    with lock:
+                        n = next(numbers, None)
+                    if n is None:
+                        break
+                    request_start = time.time()
+                    try:
+                        response = client.post('/forms/create/',
+                                {'label': self.get_label(n),
+                                'description': 'Race %d' % n})
+                    except Exception, e:
+                        status = 'error'
+                        with lock:
+                            errors.append(repr(e))
+                    else:
+                        status = response.status_code
+                    with lock:
+                        statuses[status] = statuses.get(status, 0) + 1
+                        timings.append((time.time() - request_start) * 1000)
+            finally:
+                connection.close()
+
+        start = time.time()
+        pool = [threading.Thread(target=worker) for i in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.time() - start
+
+        uiforms = UIForm.objects.filter(creator=self.user)
+        duplicates = uiforms.values('slug').annotate(count=Count('id')
+                ).filter(count__gt=1).count()
+        return {
+            'threads': threads,
+            'requests': requests,
+            'elapsed_s': elapsed,
+            'statuses': statuses,
+            'errors': errors,
+            'created': uiforms.count(),
+            'duplicate_slugs': duplicates,
+            'p50_ms': percentile(timings, 0.5),
+            'p99_ms': percentile(timings, 0.99),
+        }
+
+
+class SubmitThroughput(object):
+    def __init__(self, fields=20):
+        self.uiform = create_fixture(fields)
+        self.token_url = URLToken.objects.create(
+                uiform=self.uiform).get_absolute_url()
+        self.answers = fixture_answers(self.uiform)
+
+    def run(self, threads=8, requests=1000, ingest=False):
+        """
+        Posts the given number of valid submissions from a pool of threads,
+        with the ingester on or off, and waits until they're all stored.
+        Returns a dict of results, where accepted_rps counts responses to
+        visitors and stored_rps includes the wait for the flusher.
+        """
+        numbers = iter(xrange(requests))
+        lock = threading.Lock()
+        statuses, errors, timings = {}, [], []
+
+        def worker():
+            client = Client()
+            try:
+                while True:
+                    with lock:
+                        n = next(numbers, None)
+                    if n is None:
+                        break
+                    request_start = time.time()
+                    try:
+                        # Vary the client address so the rate limiter lets
+                        # it through
+                        response = client.post(self.token_url, self.answers,
+                                REMOTE_ADDR='10.%d.%d.%d' % (n >> 16 & 255,
+                                    n >> 8 & 255, n & 255))
+                    except Exception, e:
+                        status = 'error'
+                        with lock:
+                            errors.append(repr(e))
+                    else:
+                        status = response.status_code
+                    with lock:
+                        statuses[status] = statuses.get(status, 0) + 1
+                        timings.append((time.time() - request_start) * 1000)
+            finally:
+                connection.close()
+
+        enabled, ingester.enabled = ingester.enabled, ingest
+        before = Submission.objects.filter(uiform=self.uiform).count()
+        start = time.time()
+        try:
+            pool = [threading.Thread(target=worker) for i in range(threads)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            accepted = time.time() - start
+            if ingest:
+                ingester.flush()
+            elapsed = time.time() - start
+        finally:
+            ingester.enabled = enabled
+
+        return {
+            'ingest': ingest,
+            'threads': threads,
+            'requests': requests,
+            'accepted_s': accepted,
+            'elapsed_s': elapsed,
+            'accepted_rps': requests / accepted,
+            'stored_rps': requests / elapsed,
+            'statuses': statuses,
+            'errors': errors,
+            'stored': Submission.objects.filter(uiform=self.uiform).count()
+                - before,
+            'p50_ms': percentile(timings, 0.5),
+            'p99_ms': percentile(timings, 0.99),
+        }
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+from optparse import make_option
+import sys
+
+from forms.models import UIForm
+from forms.utils import export_fields_csv
+
+class Command(BaseCommand):
+    args = '<uiform_id>'
+    help = 'Writes the UIFields of a UIForm to stdout as JSON or CSV.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=('json', 'csv'),
+            default='json', help='Output format (default: json)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: export_uifields %s' % self.args)
+
+        try:
+            uiform = UIForm.objects.get(id=args[0])
+        except (UIForm.DoesNotExist, ValueError):
+            raise CommandError('UIForm %s not found' % args[0])
+
+        if options['format'] == 'csv':
+            sys.stdout.write(export_fields_csv(uiform))
+        else:
+            simplejson.dump(uiform.export_fields(), sys.stdout, indent=4)
+            sys.stdout.write('\n')
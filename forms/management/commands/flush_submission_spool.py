@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+from uuid import uuid4
+import os
+
+from forms.ingest import SPOOL_DIR, SPOOL_SUFFIX, REJECTED_NAME, recover_spool
+
+class Command(BaseCommand):
+    args = '[spool_dir]'
+    help = ('Stores submissions from ingest spool files left behind by '
+            'processes that stopped before flushing them.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--retry-rejected', dest='retry_rejected',
+            action='store_true', default=False,
+            help='Also try to store submissions that were rejected before'),
+    )
+
+    def handle(self, *args, **options):
+        spool_dir = args and args[0] or SPOOL_DIR
+        if not spool_dir:
+            raise CommandError('UIFORMS_INGEST_SPOOL_DIR is not set')
+
+        rejected = os.path.join(spool_dir, REJECTED_NAME)
+        if options['retry_rejected'] and os.path.exists(rejected):
+            # Turn it into a spool file, so any that fail again are rejected
+            # afresh
+            os.rename(rejected, os.path.join(spool_dir,
+                uuid4().hex + SPOOL_SUFFIX))
+
+        stored = recover_spool(spool_dir)
+        if int(options['verbosity']):
+            print 'Stored %d spooled submissions' % stored
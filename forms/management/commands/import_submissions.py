@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.encoding import smart_str
+from optparse import make_option
+import sys
+
+from forms.models import UIForm, Submission, BULK_BATCH_SIZE
+from forms.utils import iter_submission_rows
+
+class Command(BaseCommand):
+    args = '<uiform_id> <file>'
+    help = ('Validates responses to a UIForm from a JSON lines or CSV file, '
+            'and stores the valid ones.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=('json', 'csv'),
+            default=None,
+            help='File format, guessed from the extension by default'),
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=BULK_BATCH_SIZE,
+            help='Number of submissions to insert at a time'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: import_submissions %s' % self.args)
+        uiform_id, path = args
+
+        try:
+            uiform = UIForm.objects.get(id=uiform_id)
+        except (UIForm.DoesNotExist, ValueError):
+            raise CommandError('UIForm %s not found' % uiform_id)
+
+        if uiform.version_id is None:
+            uiform.publish()
+
+        format = options['format'] or (
+                path.lower().endswith('.json') and 'json' or 'csv')
+        file = open(path, 'rb')
+        try:
+            stored, failed, errors = Submission.objects.record_many(
+                    uiform.get_version(), iter_submission_rows(file, format),
+                    options['batch_size'])
+        finally:
+            file.close()
+
+        for number, row_errors in errors:
+            sys.stderr.write(smart_str(u'Row %d: %s\n' % (number, '; '.join(
+                u'%s: %s' % (key, ' '.join(messages))
+                for key, messages in sorted(row_errors.items())))))
+        if int(options['verbosity']):
+            print 'Stored %d submissions for %s, %d rows had errors' % (
+                    stored, uiform, failed)
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from forms.models import UIForm, FieldImportError
+from forms.utils import parse_field_rows
+
+class Command(BaseCommand):
+    args = '<uiform_id> <file>'
+    help = 'Creates, updates and reorders the UIFields of a UIForm from a JSON or CSV file.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', choices=('json', 'csv'),
+            default=None,
+            help='File format, guessed from the extension by default'),
+        make_option('--replace', dest='replace', action='store_true',
+            default=False, help='Delete fields that are not in the file'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: import_uifields %s' % self.args)
+        uiform_id, path = args
+
+        try:
+            uiform = UIForm.objects.get(id=uiform_id)
+        except (UIForm.DoesNotExist, ValueError):
+            raise CommandError('UIForm %s not found' % uiform_id)
+
+        format = options['format'] or (
+                path.lower().endswith('.json') and 'json' or 'csv')
+        file = open(path, 'rb')
+        try:
+            rows = parse_field_rows(file, format)
+            created, updated = uiform.import_fields(rows,
+                    replace=options['replace'])
+        except FieldImportError, e:
+            raise CommandError(str(e))
+        finally:
+            file.close()
+
+        if int(options['verbosity']):
+            print 'Imported %d new and %d updated UIFields into %s' % (
+                    created, updated, uiform)
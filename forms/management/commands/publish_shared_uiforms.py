@@ -0,0 +1,18 @@
+from django.core.management.base import NoArgsCommand
+
+from forms.models import UIForm
+
+class Command(NoArgsCommand):
+    help = ('Publishes the UIForms that were shared before they had '
+            'published versions, so token visitors can see them.')
+
+    def handle_noargs(self, **options):
+        uiforms = UIForm.objects.filter(version__isnull=True,
+                urltoken__isnull=False)
+        count = 0
+        for uiform in uiforms.iterator():
+            uiform.publish()
+            count += 1
+
+        if int(options['verbosity']):
+            print 'Published %d shared UIForms' % count
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from forms.models import UIForm
+from forms.utils import rebuild_aggregates
+
+class Command(BaseCommand):
+    args = '[uiform_id ...]'
+    help = 'Recomputes the answer aggregates of UIForms from their submissions.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Number of submissions to read at a time'),
+    )
+
+    def handle(self, *args, **options):
+        uiforms = UIForm.objects.all()
+        if args:
+            try:
+                uiforms = uiforms.filter(id__in=[int(id) for id in args])
+            except ValueError:
+                raise CommandError('UIForm ids must be integers')
+
+        for uiform in uiforms.iterator():
+            rebuild_aggregates(uiform, options['batch_size'])
+            if int(options['verbosity']):
+                print 'Rebuilt aggregates for %s' % uiform
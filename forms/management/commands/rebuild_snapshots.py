@@ -0,0 +1,38 @@
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from multiprocessing import Pool
+
+from forms.models import URLToken
+from forms.snapshots import SNAPSHOT_ROOT, snapshot_uiform
+
+def close_connection():
+    # Each worker opens its own database connection
+    connection.close()
+
+class Command(NoArgsCommand):
+    help = 'Rewrites the static snapshots of all shared UIForms.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', dest='processes', type='int', default=None,
+            help='Number of worker processes (default: one per CPU)'),
+    )
+
+    def handle_noargs(self, **options):
+        if not SNAPSHOT_ROOT:
+            raise CommandError('Set UIFORMS_SNAPSHOT_ROOT to publish snapshots')
+
+        ids = list(URLToken.objects.values_list('uiform', flat=True))
+
+        # Don't share the parent's connection with the forked workers
+        connection.close()
+        pool = Pool(options['processes'], close_connection)
+        try:
+            for id in pool.imap_unordered(snapshot_uiform, ids, 16):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+        if int(options['verbosity']):
+            print 'Wrote %d snapshots to %s' % (len(ids), SNAPSHOT_ROOT)
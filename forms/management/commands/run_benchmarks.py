@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+from optparse import make_option
+
+from forms.benchmarks import BENCHMARKS, create_fixture, run, compare
+
+class Command(BaseCommand):
+    args = '[benchmark ...]'
+    help = ('Runs the forms app micro-benchmarks against fixture data in a '
+            'test database.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--number', dest='number', type='int', default=1000,
+            help='Calls per timing run'),
+        make_option('--repeat', dest='repeat', type='int', default=3,
+            help='Timing runs per benchmark'),
+        make_option('--output', dest='output', default=None,
+            help='Write the results as JSON to this file'),
+        make_option('--compare', dest='compare', default=None,
+            help='Compare the results with a JSON file from --output'),
+    )
+
+    def handle(self, *args, **options):
+        benchmarks = [(name, setup) for name, setup in BENCHMARKS
+                if not args or name in args]
+        if not benchmarks:
+            raise CommandError('No benchmarks match %s' % ', '.join(args))
+
+        results = {}
+        # Publishing the fixture commits, so it can't be rolled back
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            fixture = create_fixture()
+            for name, setup in benchmarks:
+                results[name] = run(setup, fixture, options['number'],
+                        options['repeat'])
+                print '%-30s %10.1f us' % (name, results[name]['best_us'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['output']:
+            output = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, output, indent=4, sort_keys=True)
+            finally:
+                output.close()
+
+        if options['compare']:
+            baseline = open(options['compare'])
+            try:
+                ratios = compare(results, simplejson.load(baseline))
+            finally:
+                baseline.close()
+            for name, ratio in sorted(ratios.items()):
+                print '%-30s %9.2fx baseline' % (name, ratio)
@@ -0,0 +1,34 @@
+from __future__ import with_statement
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from forms.loadtest import CreateRace, threaded_test_database
+
+class Command(BaseCommand):
+    help = ('Creates UIForms with colliding slugs from many threads at once '
+            'against a test database, and checks every slug is distinct.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', dest='threads', type='int', default=8,
+            help='Number of concurrent clients'),
+        make_option('--requests', dest='requests', type='int', default=200,
+            help='Number of UIForms to create'),
+    )
+
+    def handle(self, *args, **options):
+        # Never race against the real database
+        with threaded_test_database():
+            results = CreateRace().run(options['threads'], options['requests'])
+
+        print '%d creates from %d threads in %.1fs, p50 %.1f ms, p99 %.1f ms' % (
+                results['requests'], results['threads'], results['elapsed_s'],
+                results['p50_ms'], results['p99_ms'])
+        print 'Responses: %s' % ', '.join('%s x %d' % item
+                for item in sorted(results['statuses'].items()))
+        for error in results['errors'][:10]:
+            print 'Error: %s' % error
+        print '%d UIForms created, %d duplicate slugs' % (results['created'],
+                results['duplicate_slugs'])
+
+        if results['errors'] or results['duplicate_slugs']:
+            raise CommandError('Concurrent creates failed')
@@ -0,0 +1,46 @@
+from __future__ import with_statement
+from django.core.management.base import BaseCommand, CommandError
+from optparse import make_option
+
+from forms.loadtest import SubmitThroughput, threaded_test_database
+
+class Command(BaseCommand):
+    help = ('Posts submissions to a shared form from many threads against a '
+            'test database, storing them inline and then through the '
+            'ingester, and compares the throughput.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--threads', dest='threads', type='int', default=8,
+            help='Number of concurrent clients'),
+        make_option('--requests', dest='requests', type='int', default=1000,
+            help='Number of submissions for each run'),
+    )
+
+    def handle(self, *args, **options):
+        runs = []
+        with threaded_test_database():
+            throughput = SubmitThroughput()
+            for ingest in (False, True):
+                runs.append(throughput.run(options['threads'],
+                        options['requests'], ingest))
+
+        failed = False
+        for results in runs:
+            print '%-7s %6.0f accepted/s, %6.0f stored/s, p50 %.1f ms, ' \
+                    'p99 %.1f ms, %d stored' % (
+                    results['ingest'] and 'ingest' or 'inline',
+                    results['accepted_rps'], results['stored_rps'],
+                    results['p50_ms'], results['p99_ms'], results['stored'])
+            print '        Responses: %s' % ', '.join('%s x %d' % item
+                    for item in sorted(results['statuses'].items()))
+            for error in results['errors'][:10]:
+                print '        Error: %s' % error
+            failed = failed or results['errors'] or \
+                    results['stored'] != results['requests']
+
+        inline, ingest = runs
+        print 'Ingester stores %.2fx as many submissions per second' % (
+                ingest['stored_rps'] / inline['stored_rps'])
+
+        if failed:
+            raise CommandError('Some submissions were not stored')
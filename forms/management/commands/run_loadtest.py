@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+from optparse import make_option
+
+from forms.loadtest import LoadDriver, MIX, parse_mix
+
+class Command(BaseCommand):
+    help = ('Replays a mix of requests against a test database and reports '
+            'throughput and latency.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--requests', dest='requests', type='int', default=1000,
+            help='Number of requests to send'),
+        make_option('--mix', dest='mix', default=None,
+            help='Weights like "submit=40,view=30,preview=15,status=15"'),
+        make_option('--fields', dest='fields', type='int', default=20,
+            help='Number of fields on the test UIForm'),
+        make_option('--seed', dest='seed', type='int', default=None,
+            help='Random seed, for a repeatable request sequence'),
+        make_option('--output', dest='output', default=None,
+            help='Write the results as JSON to this file'),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            mix = options['mix'] and parse_mix(options['mix']) or MIX
+        except ValueError, e:
+            raise CommandError('Invalid --mix: %s' % e)
+
+        # Never load test the real database
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            driver = LoadDriver(options['fields'], options['seed'])
+            results = driver.run(options['requests'], mix)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        print '%d requests in %.1fs: %.1f requests/s' % (results['requests'],
+                results['elapsed_s'], results['throughput_rps'])
+        for kind, stats in sorted(results['kinds'].items()):
+            print '%-10s %6d requests  p50 %7.1f ms  p99 %7.1f ms  %d errors' % (
+                    kind, stats['count'], stats['p50_ms'], stats['p99_ms'],
+                    stats['errors'])
+
+        if options['output']:
+            output = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, output, indent=4, sort_keys=True)
+            finally:
+                output.close()
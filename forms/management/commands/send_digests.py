@@ -0,0 +1,28 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+import time
+
+from forms.utils import send_due_digests
+
+class Command(NoArgsCommand):
+    help = ('Queues digest emails of completed forms for UIForms whose '
+            'notification policy says one is due.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--loop', dest='loop', action='store_true', default=False,
+            help='Keep running and check for due digests periodically'),
+        make_option('--sleep', dest='sleep', type='float', default=60,
+            help='Seconds to wait between checks'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options['verbosity'])
+
+        while True:
+            sent = send_due_digests()
+            if verbosity > 1 or (verbosity and sent):
+                print '%d digests queued' % sent
+
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
@@ -0,0 +1,33 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+import time
+
+from forms.utils import deliver_queued_mail
+
+class Command(NoArgsCommand):
+    help = 'Delivers emails waiting in the UIForms outbox.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of emails to send over each connection'),
+        make_option('--loop', dest='loop', action='store_true', default=False,
+            help='Keep running and poll the outbox for new emails'),
+        make_option('--sleep', dest='sleep', type='float', default=5,
+            help='Seconds to wait between polls when the outbox is empty'),
+    )
+
+    def handle_noargs(self, **options):
+        batch_size = options['batch_size']
+        verbosity = int(options['verbosity'])
+
+        while True:
+            sent, deferred = deliver_queued_mail(batch_size)
+            if verbosity > 1 or (verbosity and (sent or deferred)):
+                print '%d sent, %d deferred' % (sent, deferred)
+
+            if not options['loop']:
+                break
+
+            # Go straight on to the next batch if this one was full
+            if sent + deferred < batch_size:
+                time.sleep(options['sleep'])
@@ -0,0 +1,223 @@
+"""
+Lightweight timing metrics, recorded for a sample of requests by
+forms.middleware.InstrumentationMiddleware.
+
+Values are kept per process as histograms with fixed buckets, and can be
+read from the metrics view or dumped to UIFORMS_METRICS_FILE. Histogram
+names end in their unit, e.g. view_ms.preview_uiform or
+queries.preview_uiform for query counts.
+"""
+from django.conf import settings
+from django.template import Template
+from django.utils import simplejson
+from django.utils.functional import wraps
+import threading
+import time
+import os
+
+SAMPLE_RATE = getattr(settings, 'UIFORMS_METRICS_SAMPLE_RATE', 0.01)
+
+# File to append snapshots to, and how often, in seconds
+DUMP_FILE = getattr(settings, 'UIFORMS_METRICS_FILE', None)
+DUMP_INTERVAL = getattr(settings, 'UIFORMS_METRICS_DUMP_INTERVAL', 60)
+
+# Upper bounds of the histogram buckets
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+class Histogram(object):
+    __slots__ = ('count', 'total', 'maximum', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, fraction):
+        """ Returns the upper bound of the bucket holding the percentile """
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return i < len(BUCKETS) and BUCKETS[i] or self.maximum
+        return None
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.count and self.total / self.count or 0,
+            'max': self.maximum,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'buckets': dict(('<=%d' % bound, count) for bound, count
+                in zip(BUCKETS, self.buckets) if count),
+        }
+
+
+class Registry(object):
+    """
+    Named histograms for one process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.last_dump = time.time()
+
+    def record(self, name, value):
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(value)
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict((name, histogram.as_dict()) for name, histogram
+                    in self.histograms.items())
+        finally:
+            self.lock.release()
+
+    def maybe_dump(self):
+        """
+        Appends a snapshot to DUMP_FILE as a JSON line, at most once every
+        DUMP_INTERVAL seconds.
+        """
+        now = time.time()
+        if not DUMP_FILE or now - self.last_dump < DUMP_INTERVAL:
+            return
+        self.last_dump = now
+        line = simplejson.dumps({'time': now, 'pid': os.getpid(),
+            'metrics': self.snapshot()})
+        output = open(DUMP_FILE, 'a')
+        try:
+            output.write(line + '\n')
+        finally:
+            output.close()
+
+
+registry = Registry()
+
+
+# Totals for the sampled request running in each thread, or None
+_sample = threading.local()
+
+def start_sample():
+    _sample.current = {'queries': 0, 'query_ms': 0.0, 'template_ms': 0.0,
+            'template_depth': 0}
+    return _sample.current
+
+def end_sample():
+    current, _sample.current = getattr(_sample, 'current', None), None
+    return current
+
+def current_sample():
+    return getattr(_sample, 'current', None)
+
+
+class TimedCursor(object):
+    """
+    Cursor wrapper that adds query counts and times to a sample.
+    """
+    def __init__(self, cursor, sample):
+        self.cursor = cursor
+        self.sample = sample
+
+    def execute(self, sql, params=()):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+    def _timed(self, method, sql, params):
+        start = time.time()
+        try:
+            return method(sql, params)
+        finally:
+            self.sample['queries'] += 1
+            self.sample['query_ms'] += (time.time() - start) * 1000
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+def time_queries(connection, sample):
+    """
+    Makes the current thread's connection return TimedCursors until
+    untime_queries() is called.
+    """
+    cursor = connection.cursor
+    connection.cursor = lambda: TimedCursor(cursor(), sample)
+
+def untime_queries(connection):
+    if 'cursor' in connection.__dict__:
+        del connection.cursor
+
+
+def _timed_render(render):
+    """ Wraps Template.render to add render times to the current sample """
+    def wrapper(self, context):
+        sample = current_sample()
+        if sample is None:
+            return render(self, context)
+
+        # Only time the outermost template, which includes the others
+        sample['template_depth'] += 1
+        start = time.time()
+        try:
+            return render(self, context)
+        finally:
+            sample['template_depth'] -= 1
+            if not sample['template_depth']:
+                sample['template_ms'] += (time.time() - start) * 1000
+    wrapper.timed = True
+    return wraps(render)(wrapper)
+
+_render_lock = threading.Lock()
+
+def time_templates():
+    """
+    Makes Template.render add to the current sample's template_ms. It's
+    patched for every app, so only InstrumentationMiddleware calls this, and
+    only the first call patches it.
+    """
+    _render_lock.acquire()
+    try:
+        if not getattr(Template.render, 'timed', False):
+            Template.render = _timed_render(Template.render)
+    finally:
+        _render_lock.release()
+
+
+class timer(object):
+    """
+    Records how long a with block takes, in milliseconds, e.g.
+    "with timer('email_send_ms'): ..."
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, type, value, traceback):
+        registry.record(self.name, (time.time() - self.start) * 1000)
@@ -0,0 +1,62 @@
+from django.db import connections
+import random
+import time
+
+from metrics import SAMPLE_RATE, registry, start_sample, end_sample, \
+        time_queries, untime_queries, time_templates
+from routers import READ_DATABASES, READ_METHODS, REPLICA_LAG, PRIMARY_COOKIE
+import urls
+
+# View functions mapped to their URL names
+VIEW_NAMES = dict((pattern.callback, pattern.name)
+        for pattern in urls.urlpatterns if pattern.name)
+
+
+class InstrumentationMiddleware(object):
+    """
+    Records latency, query count and time, and template render time for a
+    sample of requests to the forms app, per URL name. Set
+    UIFORMS_METRICS_SAMPLE_RATE to choose the fraction of requests sampled.
+    """
+    def __init__(self):
+        time_templates()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        name = VIEW_NAMES.get(view_func)
+        if name is None or random.random() >= SAMPLE_RATE:
+            return None
+
+        request._metrics = (name, time.time(), start_sample())
+        for connection in connections.all():
+            time_queries(connection, request._metrics[2])
+        return None
+
+    def process_response(self, request, response):
+        metrics = getattr(request, '_metrics', None)
+        if metrics is None:
+            return response
+
+        name, start, sample = metrics
+        del request._metrics
+        end_sample()
+        for connection in connections.all():
+            untime_queries(connection)
+
+        registry.record('view_ms.%s' % name, (time.time() - start) * 1000)
+        registry.record('query_ms.%s' % name, sample['query_ms'])
+        registry.record('queries.%s' % name, sample['queries'])
+        registry.record('template_ms.%s' % name, sample['template_ms'])
+        registry.maybe_dump()
+        return response
+
+
+class ReplicaMiddleware(object):
+    """
+    Keeps a visitor's reads on the default database for UIFORMS_REPLICA_LAG
+    seconds after they POST, so @use_replica views show them their own
+    changes before the replicas catch up.
+    """
+    def process_response(self, request, response):
+        if READ_DATABASES and request.method not in READ_METHODS:
+            response.set_cookie(PRIMARY_COOKIE, '1', max_age=REPLICA_LAG)
+        return response
@@ -1,28 +1,249 @@
-from django.db import models
+from django.db import models, transaction, connection, IntegrityError, \
+        DEFAULT_DB_ALIAS
+from django.db.models import F, Q, Max
 from django.contrib.auth.models import User
 from django.template.defaultfilters import slugify
 from django import forms
 from django.forms.models import inlineformset_factory
-from django.db.models.signals import post_save, post_delete
-from datetime import datetime
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.core.exceptions import ValidationError
+from django.core.cache import cache
+from django.utils import simplejson
+from django.conf import settings
+from django.utils.functional import wraps
+from datetime import datetime, timedelta
 from uuid import uuid4
+from notify import notifier, get_version, DELETED
+from tokens import resolver as token_resolver, LRUCache
+from snapshots import SNAPSHOT_ROOT, write_snapshot, delete_snapshot
+from serializers import timestamp
+from kinds import kind_choices, get_kind, split_choices, compile_uifield
+import threading
+import sys
+
+# UIForms touched by UIField changes inside a batched_field_updates() block,
+# per thread
+_batch = threading.local()
+
+def touch_uiforms(ids):
+    """
+    Sets last_updated on the given UIForms to now, with one UPDATE per form
+    rather than a full save(). Returns (id, version) pairs for the UIForms
+    that were updated, to pass to announce_uiforms() once committed.
+    """
+    now = datetime.now()
+    return [(id, timestamp(now)) for id in ids
+            if UIForm.objects.filter(id=id).update(last_updated=now)]
+
+def announce_uiforms(versions):
+    """
+    Drops UIForms from the token resolver's cache and wakes up anyone
+    watching them, given (id, version) pairs from touch_uiforms(). Call it
+    after the changes have committed, or a request in between could cache or
+    be shown the old state.
+    """
+    for id, version in versions:
+        token_resolver.invalidate_uiform(id)
+        notifier.publish(id, version)
+
+
+class batched_field_updates(object):
+    """
+    Runs a block in a transaction, like transaction.commit_on_success, and
+    collects the UIForms touched by UIField saves and deletes in it. When the
+    outermost block exits without an error, each of their timestamps is
+    updated once in the same commit, and they're announced after it. Use it
+    in a with statement or as a decorator.
+    """
+    def __enter__(self):
+        self.outermost = getattr(_batch, 'touched', None) is None
+        if self.outermost:
+            _batch.touched = set()
+            transaction.enter_transaction_management()
+            transaction.managed(True)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if not self.outermost:
+            return
+        touched, _batch.touched = _batch.touched, None
+        versions = []
+        try:
+            if type is not None:
+                if transaction.is_dirty():
+                    transaction.rollback()
+            else:
+                try:
+                    versions = touch_uiforms(touched)
+                    if transaction.is_dirty():
+                        transaction.commit()
+                except:
+                    transaction.rollback()
+                    raise
+        finally:
+            transaction.leave_transaction_management()
+        announce_uiforms(versions)
+
+    def __call__(self, func):
+        def wrapper(*args, **kw):
+            batch = batched_field_updates()
+            batch.__enter__()
+            try:
+                result = func(*args, **kw)
+            except:
+                batch.__exit__(*sys.exc_info())
+                raise
+            batch.__exit__(None, None, None)
+            return result
+        return wraps(func)(wrapper)
+
+
+def encode_cursor(uiform):
+    """ Returns a pagination cursor pointing just after the given UIForm """
+    return '%s_%d' % (uiform.last_updated.isoformat(), uiform.id)
+
+def decode_cursor(cursor):
+    """
+    Returns the (last_updated, id) pair in a cursor from encode_cursor().
+    Raises ValueError if the cursor is invalid.
+    """
+    timestamp, id = cursor.rsplit('_', 1)
+    return parse_timestamp(timestamp), int(id)
+
+def parse_timestamp(value):
+    """
+    Parses a timestamp in the format of datetime.isoformat(). Raises
+    ValueError if it's invalid.
+    """
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp %r' % value)
+
+
+# Slugs tried when inserting a new UIForm before giving up
+SLUG_ATTEMPTS = 10
+
+def slug_candidates(label, max_length):
+    """
+    Yields slugs to try for a new UIForm: the slugified label, the same with
+    -2 and -3 appended, and then with random suffixes, so that creating many
+    forms with the same slug doesn't try every number that's been taken.
+    """
+    base = slugify(label)[:max_length] or 'uiform'
+    yield base
+    for n in (2, 3):
+        suffix = '-%d' % n
+        yield base[:max_length - len(suffix)] + suffix
+    while True:
+        suffix = '-%s' % uuid4().hex[:6]
+        yield base[:max_length - len(suffix)] + suffix
+
+
+class UIFormManager(models.Manager):
+    def owned_by(self, user):
+        """
+        Returns the UIForms created by a user, filtered on creator_id so the
+        lookup doesn't join auth_user.
+        """
+        return self.filter(creator=user.id)
+
+    def with_counts(self):
+        """
+        Annotates UIForms with field_count and submission_count, using
+        subqueries so a form's fields and submissions are never joined.
+        """
+        qn = connection.ops.quote_name
+        subquery = 'SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s'
+        uiform_table = qn(UIForm._meta.db_table)
+        counts = {}
+        for name, model in (('field_count', UIField),
+                ('submission_count', Submission)):
+            table = qn(model._meta.db_table)
+            counts[name] = subquery % (table, table, qn('uiform_id'),
+                    uiform_table, qn('id'))
+        return self.get_query_set().extra(select=counts)
+
+    def page(self, creator, cursor=None, size=25):
+        """
+        Returns a (uiforms, next_cursor) pair for a page of a user's UIForms,
+        most recently updated first. The page is found by seeking on
+        (creator, last_updated, id) rather than with an OFFSET, so deep pages
+        are as cheap as the first. next_cursor is None on the last page.
+        """
+        query = self.with_counts().filter(creator=creator.id).order_by(
+                '-last_updated', '-id')
+        if cursor:
+            last_updated, id = decode_cursor(cursor)
+            query = query.filter(Q(last_updated__lt=last_updated) |
+                    Q(last_updated=last_updated, id__lt=id))
+
+        uiforms = list(query[:size + 1])
+        if len(uiforms) > size:
+            return uiforms[:size], encode_cursor(uiforms[size - 1])
+        return uiforms, None
+
+
+# How a UIForm's creator is told about completed forms
+NOTIFY_IMMEDIATE, NOTIFY_BATCHED, NOTIFY_DAILY = 'I', 'B', 'D'
 
 class UIForm(models.Model):
     """
     Represents a form created by the user.
     """
+    notification_policies = (
+        (NOTIFY_IMMEDIATE, 'An email for every response'),
+        (NOTIFY_BATCHED, 'A digest every few minutes'),
+        (NOTIFY_DAILY, 'A daily digest'),
+    )
+
     label = models.CharField(max_length=140)
     description = models.TextField()
     creator = models.ForeignKey(User)
     slug = models.SlugField(editable=False)
     last_updated = models.DateTimeField(auto_now=True)
+    # The SchemaVersion that token visitors see
+    version = models.ForeignKey('SchemaVersion', null=True, editable=False,
+            related_name='+')
+    notification_policy = models.CharField(max_length=1,
+            choices=notification_policies, default=NOTIFY_IMMEDIATE)
+    notification_minutes = models.PositiveIntegerField(default=60,
+            help_text='Minutes between batched digests')
+    # When the last digest of responses was sent
+    last_digest = models.DateTimeField(null=True, editable=False)
+
+    # The composite index on (creator, last_updated) is created by
+    # sql/uiform.sql
+    objects = UIFormManager()
+
+    class Meta:
+        unique_together = ('creator', 'slug')
 
     def save(self, **kw):
-        # Populate slug field when first saved
-        if not self.id:
-            self.slug = slugify(self.label)
+        if self.id:
+            return super(UIForm, self).save(**kw)
 
-        super(UIForm, self).save(**kw)
+        # Populate slug field when first saved. Slugs are allocated by
+        # inserting and trying the next candidate if the unique (creator,
+        # slug) index rejects it, since checking for a free slug first would
+        # race with concurrent creates. Each attempt is in a savepoint so a
+        # failed INSERT doesn't abort the enclosing transaction.
+        max_length = self._meta.get_field('slug').max_length
+        candidates = slug_candidates(self.label, max_length)
+        for attempt in range(SLUG_ATTEMPTS):
+            self.slug = candidates.next()
+            sid = transaction.savepoint()
+            try:
+                super(UIForm, self).save(**kw)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                if attempt == SLUG_ATTEMPTS - 1:
+                    raise
+            else:
+                transaction.savepoint_commit(sid)
+                return
 
     @models.permalink
     def get_absolute_url(self):
@@ -31,12 +252,258 @@ class UIForm(models.Model):
     def __unicode__(self):
         return 'URLForm "%s"' % self.label
 
+    def get_field_spec(self):
+        """
+        Returns the current UIFields as a list of (id, kind, label,
+        description, choices, minimum, maximum) tuples.
+        """
+        return [(f.id, f.kind, f.label, f.description, f.get_choices(),
+            f.minimum, f.maximum) for f in self.uifield_set.all()]
+
+    def publish(self):
+        """
+        Snapshots the current label, description and UIFields into a new
+        SchemaVersion and shows it to token visitors. If nothing has changed
+        since the last publish, the published version is kept.
+
+        Returns the published SchemaVersion.
+        """
+        version, created = self.create_version()
+        if created:
+            # Only once it's committed, or a token visit in between could
+            # cache the old version again
+            token_resolver.invalidate_uiform(self.id)
+            if SNAPSHOT_ROOT:
+                write_snapshot(self)
+        return version
+
+    @transaction.commit_on_success
+    def create_version(self):
+        """
+        Stores and points this UIForm at a new SchemaVersion, unless nothing
+        has changed since the last one. Returns a tuple of (the published
+        SchemaVersion, whether it was created). Use publish() instead.
+        """
+        schema = SchemaVersion.serialize({
+            'label': self.label,
+            'description': self.description,
+            'fields': self.get_field_spec(),
+        })
+        if self.version_id:
+            version = get_schema_version(self.version_id)
+            if version.schema == schema:
+                return version, False
+
+        last = self.schemaversion_set.aggregate(last=Max('number'))['last']
+        version = SchemaVersion.objects.create(uiform=self,
+                number=(last or 0) + 1, schema=schema)
+        # Create the aggregates up front, so submissions only UPDATE them
+        FieldAggregate.objects.get_ids([(field[0], field[1])
+            for field in version.get_schema()['fields']])
+
+        # Only move the pointer, as a full save() of this instance could undo
+        # changes saved since it was loaded
+        self.version = version
+        UIForm.objects.filter(id=self.id).update(version=version)
+        return version, True
+
+    def get_version(self, id=None):
+        """
+        Returns this UIForm's SchemaVersion with the given id, such as the
+        version a visitor's form was rendered from, or the published version
+        if id isn't one of this UIForm's. Raises SchemaVersion.DoesNotExist
+        if this UIForm has never been published.
+        """
+        if id and str(id) != str(self.version_id):
+            try:
+                version = get_schema_version(int(id))
+            except (ValueError, SchemaVersion.DoesNotExist):
+                pass
+            else:
+                if version.uiform_id == self.id:
+                    return version
+
+        if self.version_id is None:
+            raise SchemaVersion.DoesNotExist('%s has not been published' % self)
+        return get_schema_version(self.version_id)
+
+    def digest_due(self, now):
+        """
+        Returns whether responses waiting for a digest should be sent now.
+        """
+        if self.last_digest is None or \
+                self.notification_policy == NOTIFY_IMMEDIATE:
+            # Also sends anything left from before switching to immediate
+            return True
+        if self.notification_policy == NOTIFY_DAILY:
+            return self.last_digest.date() < now.date()
+        return now >= self.last_digest + timedelta(
+                minutes=self.notification_minutes)
+
     def get_preview_form(self, data=None):
         """ Return a form for viewing or processing this UIForm """
-        if data:
-            return PreviewForm(self, data)
+        form_class = compile_preview_form(self)
+        if data is not None:
+            return form_class(data)
         else:
-            return PreviewForm(self)
+            return form_class()
+
+    def get_field_stats(self):
+        """
+        Returns a list of dicts with the aggregated answers to each UIField,
+        read from the FieldAggregates rather than the Submissions.
+        """
+        aggregates = dict(((a.uifield_id, a.kind), a) for a in
+                FieldAggregate.objects.filter(uifield__uiform=self))
+        histograms = {}
+        for bucket in AggregateBucket.objects.filter(
+                aggregate__uifield__uiform=self).order_by('start'):
+            histograms.setdefault(bucket.aggregate_id, []).append(
+                    [bucket.start, bucket.count])
+
+        stats = []
+        for uifield in self.uifield_set.all():
+            aggregate = aggregates.get((uifield.id, uifield.kind),
+                    FieldAggregate())
+            field_stats = {
+                'id': uifield.id,
+                'label': uifield.label,
+                'kind': uifield.kind,
+                'count': aggregate.count,
+            }
+            kind = get_kind(uifield.kind)
+            if kind is not None:
+                field_stats.update(kind.get_stats(aggregate,
+                    histograms.get(aggregate.id, []), uifield.get_choices()))
+            stats.append(field_stats)
+        return stats
+
+    @batched_field_updates()
+    def edit_fields(self, create=(), update=(), delete=()):
+        """
+        Changes many UIFields at once, in one transaction and with a single
+        timestamp update. create is a list of dicts of UIField attributes,
+        update is a list of such dicts that also include the id, and delete
+        is a list of ids. Updates are applied with one UPDATE per field and
+        send no signals.
+
+        Returns the list of created UIFields. Raises ValidationError, before
+        changing anything, if a created or updated field's options don't
+        suit its kind.
+        """
+        fields = self.uifield_set.all()
+
+        # Check options the way the UIField formset does
+        for attrs in create:
+            UIField(uiform=self, **attrs).clean()
+        changed = [changes for changes in update
+                if set(changes) & set(UIFIELD_OPTIONS)]
+        current = fields.in_bulk([changes['id'] for changes in changed])
+        for changes in changed:
+            field = current.get(changes['id'])
+            if field is not None:
+                for name, value in changes.items():
+                    setattr(field, name, value)
+                field.clean()
+
+        for changes in update:
+            changes = dict(changes)
+            fields.filter(id=changes.pop('id')).update(**changes)
+        if update:
+            _batch.touched.add(self.id)
+        if delete:
+            fields.filter(id__in=delete).delete()
+
+        created = []
+        for attrs in create:
+            created.append(UIField.objects.create(uiform=self, **attrs))
+        return created
+
+    @batched_field_updates()
+    def import_fields(self, rows, replace=False):
+        """
+        Creates, updates and reorders UIFields from a list of dicts with
+        label, kind, description, choices, minimum and maximum keys, in one
+        transaction. Rows with the
+        id of one of this UIForm's fields update it, other rows create new
+        fields, and fields end up in the order of the rows. If replace is
+        True, fields that aren't in the rows are deleted, otherwise they keep
+        their positions and the rows are placed after them.
+
+        Rows are written with a single executemany() per statement, so no
+        per-row signals are sent. Raises FieldImportError for invalid rows.
+        """
+        label_length = UIField._meta.get_field('label').max_length
+        positions = dict(self.uifield_set.values_list('id', 'position'))
+        existing = set(positions)
+        offset = 0
+        if positions and not replace:
+            offset = max(positions.values()) + 1
+
+        inserts, updates = [], []
+        for position, row in enumerate(rows):
+            label = (row.get('label') or '').strip()
+            kind = row.get('kind') or 'B'
+            description = row.get('description') or ''
+            choices = row.get('choices') or ''
+            if isinstance(choices, list):
+                choices = '\n'.join(choices)
+            if not label or len(label) > label_length:
+                raise FieldImportError('Row %d: label must be 1-%d characters'
+                        % (position + 1, label_length))
+            if get_kind(kind) is None:
+                raise FieldImportError('Row %d: unknown kind "%s"'
+                        % (position + 1, kind))
+
+            try:
+                id = int(row.get('id') or 0)
+                minimum, maximum = [None if row.get(key) in (None, '')
+                        else int(row[key]) for key in ('minimum', 'maximum')]
+            except (TypeError, ValueError):
+                raise FieldImportError('Row %d: invalid number' % (position + 1))
+            try:
+                get_kind(kind).check_options(split_choices(choices), minimum,
+                        maximum)
+            except ValidationError, e:
+                raise FieldImportError('Row %d: %s' % (position + 1,
+                    ' '.join(e.messages)))
+
+            values = (label, kind, description, choices, minimum, maximum,
+                    offset + position)
+            if id in existing:
+                updates.append(values + (id,))
+                existing.discard(id)
+            else:
+                inserts.append(values + (self.id,))
+
+        if replace and existing:
+            self.uifield_set.filter(id__in=existing).delete()
+
+        qn = connection.ops.quote_name
+        table = qn(UIField._meta.db_table)
+        cursor = connection.cursor()
+        columns = [qn(column) for column in ('label', 'kind', 'description',
+            'choices', 'minimum', 'maximum', 'position')]
+        if updates:
+            cursor.executemany('UPDATE %s SET %s WHERE %s = %%s' % (table,
+                ', '.join('%s = %%s' % column for column in columns),
+                qn('id')), updates)
+        if inserts:
+            cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (table,
+                ', '.join(columns + [qn('uiform_id')]),
+                ', '.join(['%s'] * (len(columns) + 1))), inserts)
+        transaction.set_dirty()
+
+        _batch.touched.add(self.id)
+        return len(inserts), len(updates)
+
+    def export_fields(self):
+        """
+        Returns the UIFields as a list of dicts, in order, in the format
+        accepted by import_fields().
+        """
+        return list(self.uifield_set.values('id', 'label', 'kind',
+            'description', 'choices', 'minimum', 'maximum'))
 
     def get_field_formset(self, data=None, **kw):
         """ 
@@ -51,33 +518,178 @@ class UIForm(models.Model):
         return formset
 
 
+# UIField attributes that UIField.clean() checks against the kind
+UIFIELD_OPTIONS = ('kind', 'choices', 'minimum', 'maximum')
+
 class UIField(models.Model):
     """
     Represents a field in a UIForm.
     """
-    field_types = (
-        ('B', 'Boolean'),
-        ('I', 'Integer'),
-    )
+    field_types = kind_choices()
 
     label = models.CharField(max_length=50)
     kind = models.CharField(max_length=1, choices=field_types, default='B')
     description = models.TextField(blank=True)
+    choices = models.TextField(blank=True,
+            help_text='For Choice fields, one choice per line')
+    minimum = models.IntegerField(null=True, blank=True,
+            help_text='For Range fields')
+    maximum = models.IntegerField(null=True, blank=True,
+            help_text='For Range fields')
     uiform = models.ForeignKey(UIForm, editable=False)
+    position = models.PositiveIntegerField(editable=False)
+
+    class Meta:
+        ordering = ('position', 'id')
+
+    def clean(self):
+        kind = get_kind(self.kind)
+        if kind is not None:
+            kind.check_options(self.get_choices(), self.minimum, self.maximum)
+
+    def get_choices(self):
+        return split_choices(self.choices)
+
+    def save(self, **kw):
+        # Add new fields to the end of the UIForm unless placed explicitly
+        if not self.id and self.position is None:
+            last = UIField.objects.filter(uiform=self.uiform_id).aggregate(
+                    last=Max('position'))['last']
+            self.position = 0 if last is None else last + 1
+
+        super(UIField, self).save(**kw)
+
+
+class FieldImportError(Exception):
+    pass
+
+
+# Seconds to keep SchemaVersions and things built from them in caches. They
+# never change, so they're only evicted, never invalidated.
+VERSION_TIMEOUT = 60 * 60 * 24 * 7
+
+# Number of SchemaVersions and compiled forms kept in each process
+VERSION_CACHE_SIZE = getattr(settings, 'UIFORMS_VERSION_CACHE_SIZE', 1000)
+
+# Cache keys of a SchemaVersion and of its rendered fields
+VERSION_KEY = 'uiforms:schema_version:%d'
+VERSION_FIELDS_KEY = 'uiforms:version_fields:%d'
+
+_schema_versions = LRUCache(VERSION_CACHE_SIZE)
+
+def get_schema_version(id):
+    """
+    Returns a SchemaVersion by id, from this process, the cache backend or
+    the database. Raises SchemaVersion.DoesNotExist.
+    """
+    version = _schema_versions.get(id)
+    if version is None:
+        key = VERSION_KEY % id
+        version = cache.get(key)
+        if version is None:
+            # Read from the primary, which has versions published moments ago
+            version = SchemaVersion.objects.using(DEFAULT_DB_ALIAS).get(id=id)
+            cache.set(key, version, VERSION_TIMEOUT)
+        _schema_versions.set(id, version, VERSION_TIMEOUT)
+    return version
+
+
+class SchemaVersion(models.Model):
+    """
+    An immutable snapshot of a UIForm's label, description and UIFields,
+    created when the UIForm is published. Token visitors see the published
+    version and Submissions record the version they answered, so forms and
+    HTML built from a version can be cached for as long as it's used.
+    """
+    uiform = models.ForeignKey(UIForm, editable=False)
+    number = models.PositiveIntegerField(editable=False)
+    published = models.DateTimeField(auto_now_add=True)
+    schema = models.TextField(editable=False)
+
+    class Meta:
+        unique_together = ('uiform', 'number')
+
+    def __unicode__(self):
+        return 'Version %d of UIForm %d' % (self.number, self.uiform_id)
+
+    @staticmethod
+    def serialize(schema):
+        """ Returns the compact JSON stored in the schema column """
+        return simplejson.dumps(schema, sort_keys=True, separators=(',', ':'))
+
+    def get_schema(self):
+        """
+        Returns a dict of the label, description, and fields as a list of
+        UIField.get_field_spec() lists.
+        """
+        if not hasattr(self, '_schema'):
+            self._schema = simplejson.loads(self.schema)
+        return self._schema
+
+    @property
+    def label(self):
+        return self.get_schema()['label']
+
+    @property
+    def description(self):
+        return self.get_schema()['description']
+
+    def get_form_class(self):
+        return compile_version_form(self)
+
+
+def forget_schema_version(sender, instance, **kw):
+    """
+    Drop a deleted SchemaVersion from the caches. Versions never change, but
+    some databases reuse the ids of deleted rows.
+    """
+    _schema_versions.delete(instance.id)
+    _version_form_classes.delete(instance.id)
+    cache.delete(VERSION_KEY % instance.id)
+    cache.delete(VERSION_FIELDS_KEY % instance.id)
+
+post_delete.connect(forget_schema_version, sender=SchemaVersion)
 
 
 def update_field_parent(sender, instance, created=False, **kw):
     """
     Update the timestamp on the parent UIForm when a UIField is saved. 
     """
-    uiform = instance.uiform
-    uiform.last_updated = datetime.now()
-    uiform.save()
+    touched = getattr(_batch, 'touched', None)
+    if touched is not None:
+        touched.add(instance.uiform_id)
+    else:
+        # Outside a batch, save() has already committed, unless the caller
+        # manages the transaction
+        announce_uiforms(touch_uiforms([instance.uiform_id]))
 
 post_save.connect(update_field_parent, sender=UIField)
 post_delete.connect(update_field_parent, sender=UIField)
 
 
+def publish_uiform_change(sender, instance, **kw):
+    """
+    Wake up clients watching a UIForm when it is saved or deleted.
+    """
+    notifier.publish(instance.id, get_version(instance))
+
+def publish_uiform_delete(sender, instance, **kw):
+    notifier.publish(instance.id, DELETED)
+
+post_save.connect(publish_uiform_change, sender=UIForm)
+post_delete.connect(publish_uiform_delete, sender=UIForm)
+
+
+def invalidate_cached_uiform(sender, instance, **kw):
+    """
+    Drop a saved or deleted UIForm from the token resolver's cache.
+    """
+    token_resolver.invalidate_uiform(instance.id)
+
+post_save.connect(invalidate_cached_uiform, sender=UIForm)
+post_delete.connect(invalidate_cached_uiform, sender=UIForm)
+
+
 
 class URLToken(models.Model):
     """ 
@@ -85,7 +697,7 @@ class URLToken(models.Model):
     Note: the token is automatically generated on first save with uuid.uuid4()
     """
     uiform = models.ForeignKey(UIForm, unique=True)
-    token = models.CharField(max_length=64, editable=False)
+    token = models.CharField(max_length=64, editable=False, unique=True)
 
     def save(self, **kw):
         # Populate token field when first saved
@@ -105,6 +717,419 @@ class URLToken(models.Model):
         return 'URLToken for "%s" : %s' % (self.uiform.label, self.token)
 
 
+def invalidate_cached_token(sender, instance, **kw):
+    """
+    Forget a URLToken when it's deleted, or when it's created in case it was
+    cached as unknown.
+    """
+    token_resolver.invalidate_token(instance.token)
+
+post_save.connect(invalidate_cached_token, sender=URLToken)
+post_delete.connect(invalidate_cached_token, sender=URLToken)
+
+
+def update_snapshot(sender, instance, **kw):
+    """
+    Rewrite the static snapshot of a shared UIForm when it's saved.
+    """
+    if isinstance(instance, URLToken):
+        instance = instance.uiform
+    write_snapshot(instance)
+
+def remove_snapshot(sender, instance, **kw):
+    delete_snapshot(instance)
+
+if SNAPSHOT_ROOT:
+    post_save.connect(update_snapshot, sender=UIForm)
+    post_save.connect(update_snapshot, sender=URLToken)
+    pre_delete.connect(remove_snapshot, sender=URLToken)
+
+
+
+# Submissions validated and inserted at a time by SubmissionManager.record_many()
+BULK_BATCH_SIZE = getattr(settings, 'UIFORMS_BULK_BATCH_SIZE', 1000)
+
+# Rows per multi-row INSERT, within SQLite's limit of 999 parameters
+INSERT_CHUNK = 200
+
+# Limits on a file of responses uploaded to the import_submissions view
+IMPORT_MAX_SIZE = getattr(settings, 'UIFORMS_IMPORT_MAX_SIZE', 10 * 1024 * 1024)
+IMPORT_MAX_ROWS = getattr(settings, 'UIFORMS_IMPORT_MAX_ROWS', 10000)
+
+# Rows whose errors are returned by the import_submissions view
+IMPORT_MAX_ERRORS = getattr(settings, 'UIFORMS_IMPORT_MAX_ERRORS', 100)
+
+class SubmissionManager(models.Manager):
+    @transaction.commit_on_success
+    def record(self, version, answers):
+        """
+        Stores a dict of {UIField id: answer} validated against a
+        SchemaVersion, and adds them to the FieldAggregates in the same
+        transaction.
+        """
+        submission = self.create(uiform_id=version.uiform_id, version=version,
+                answers=simplejson.dumps(answers))
+        FieldAggregate.objects.add_measures(
+                version.get_form_class().measure(answers))
+        return submission
+
+    @transaction.commit_on_success
+    def record_many(self, version, rows, batch_size=BULK_BATCH_SIZE,
+            max_errors=None):
+        """
+        Validates and stores many responses to a SchemaVersion in one pass,
+        from an iterable of (row number, {key: value}, error) tuples such as
+        utils.iter_submission_rows() yields. Values are keyed by UIField id
+        or label, and an optional 'submitted' timestamp keeps the time a
+        response was collected. Invalid rows are skipped.
+
+        Valid rows are inserted batch_size at a time with insert_rows(), and
+        their answers are added to the FieldAggregates once at the end, so the
+        rows are never all held in memory. No per-row signals are sent.
+        Returns a tuple of (number of Submissions stored, number of rows with
+        errors, [(row number, {key: error messages})]), keeping the errors of
+        at most max_errors rows.
+        """
+        form_class = version.get_form_class()
+        totals = AggregateTotals()
+        now = datetime.now()
+
+        stored, failed, errors, batch = 0, 0, [], []
+        def add_errors(number, row_errors):
+            if max_errors is None or len(errors) < max_errors:
+                errors.append((number, row_errors))
+
+        for number, values, error in rows:
+            if error:
+                failed += 1
+                add_errors(number, {'__all__': [error]})
+                continue
+
+            submitted = values.pop('submitted', None)
+            values.pop('id', None)
+            answers, row_errors = form_class.validate_values(values)
+            try:
+                submitted = submitted and parse_timestamp(submitted) or now
+            except ValueError:
+                row_errors['submitted'] = ['Enter a valid date and time.']
+            if row_errors:
+                failed += 1
+                add_errors(number, row_errors)
+                continue
+
+            batch.append((version.uiform_id, version.id, submitted,
+                simplejson.dumps(answers)))
+            totals.add(form_class.measure(answers))
+            if len(batch) >= batch_size:
+                self.insert_rows(batch)
+                stored += len(batch)
+                batch = []
+
+        if batch:
+            self.insert_rows(batch)
+            stored += len(batch)
+        transaction.set_dirty()
+
+        FieldAggregate.objects.add_totals(totals)
+        return stored, failed, errors
+
+    @transaction.commit_on_success
+    def record_batch(self, entries):
+        """
+        Stores a list of (SchemaVersion, submitted, answers) entries that have
+        already been validated, possibly for different UIForms, with
+        insert_rows() and one set of FieldAggregate updates.
+        """
+        totals = AggregateTotals()
+        rows = []
+        for version, submitted, answers in entries:
+            rows.append((version.uiform_id, version.id, submitted,
+                simplejson.dumps(answers)))
+            totals.add(version.get_form_class().measure(answers))
+
+        self.insert_rows(rows)
+        transaction.set_dirty()
+        FieldAggregate.objects.add_totals(totals)
+
+    def insert_rows(self, rows):
+        """
+        Inserts Submissions from a list of (uiform id, version id, submitted,
+        answers JSON) tuples, INSERT_CHUNK rows per statement, without
+        sending signals. The caller manages the transaction.
+        """
+        qn = connection.ops.quote_name
+        sql = 'INSERT INTO %s (%s, %s, %s, %s) VALUES ' % (
+                qn(self.model._meta.db_table), qn('uiform_id'),
+                qn('version_id'), qn('submitted'), qn('answers'))
+        params = [(uiform_id, version_id,
+            connection.ops.value_to_db_datetime(submitted), answers)
+            for uiform_id, version_id, submitted, answers in rows]
+        cursor = connection.cursor()
+
+        if connection.settings_dict['ENGINE'].endswith('oracle'):
+            # No multi-row VALUES lists
+            cursor.executemany(sql + '(%s, %s, %s, %s)', params)
+            return
+        for start in xrange(0, len(params), INSERT_CHUNK):
+            chunk = params[start:start + INSERT_CHUNK]
+            cursor.execute(sql + ', '.join(['(%s, %s, %s, %s)'] * len(chunk)),
+                    [value for row in chunk for value in row])
+
+
+class Submission(models.Model):
+    """
+    A single response to a UIForm. The answers are stored as a JSON object
+    keyed by UIField id, so one row holds the whole response.
+    """
+    uiform = models.ForeignKey(UIForm, editable=False)
+    # The SchemaVersion that was answered, or None for older Submissions
+    version = models.ForeignKey(SchemaVersion, null=True, editable=False)
+    submitted = models.DateTimeField(auto_now_add=True)
+    answers = models.TextField(editable=False)
+
+    objects = SubmissionManager()
+
+    def __unicode__(self):
+        return 'Submission for "%s" at %s' % (self.uiform.label, self.submitted)
+
+    def get_answers(self):
+        """ Returns the answers as a dict of {UIField id: answer} """
+        return dict((int(id), answer) for id, answer
+                in simplejson.loads(self.answers).items())
+
+
+
+class AggregateTotals(object):
+    """
+    Sums the measures of many answers, so they can be added to the
+    FieldAggregates with one UPDATE, plus one per histogram bucket.
+    """
+    def __init__(self):
+        # {(UIField id, kind): [count, total, minimum, maximum,
+        #  {bucket: count}]}
+        self.fields = {}
+
+    def add(self, measures):
+        """ Adds a dict of {(UIField id, kind): (value, bucket)} """
+        for key, (value, bucket) in measures.items():
+            totals = self.fields.get(key)
+            if totals is None:
+                totals = self.fields[key] = [0, 0, None, None, {}]
+            totals[0] += 1
+            if value is not None:
+                totals[1] += value
+                if totals[2] is None or value < totals[2]:
+                    totals[2] = value
+                if totals[3] is None or value > totals[3]:
+                    totals[3] = value
+            if bucket is not None:
+                totals[4][bucket] = totals[4].get(bucket, 0) + 1
+
+
+class FieldAggregateManager(models.Manager):
+    def add_measures(self, measures):
+        """
+        Adds a dict of {(UIField id, kind): (value, bucket)} from
+        PreviewForm.measure() to the aggregates.
+        """
+        totals = AggregateTotals()
+        totals.add(measures)
+        self.add_totals(totals)
+
+    def get_ids(self, keys):
+        """
+        Returns {(UIField id, kind): FieldAggregate id} for a list of (UIField
+        id, kind) pairs, creating any aggregates that don't exist yet.
+        UIFields that have been deleted are left out.
+        """
+        keys = set(keys)
+        ids = dict(((uifield_id, kind), id) for uifield_id, kind, id in
+            self.filter(uifield__in=set(key[0] for key in keys)).values_list(
+                'uifield', 'kind', 'id'))
+        for uifield_id, kind in keys - set(ids):
+            # In a savepoint, so a concurrent insert doesn't abort the
+            # enclosing transaction
+            sid = transaction.savepoint()
+            try:
+                ids[uifield_id, kind] = self.create(uifield_id=uifield_id,
+                        kind=kind).id
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                try:
+                    ids[uifield_id, kind] = self.get(uifield=uifield_id,
+                            kind=kind).id
+                except self.model.DoesNotExist:
+                    pass
+            else:
+                transaction.savepoint_commit(sid)
+        return ids
+
+    def add_totals(self, totals):
+        """
+        Adds AggregateTotals to the aggregates, with a single UPDATE for all
+        the UIFields and one per histogram bucket, so concurrent submissions
+        can't lose counts. Aggregates are normally created when their UIForm
+        is published, and any that are missing are created first.
+        """
+        ids = self.get_ids(totals.fields.keys())
+        fields = [(ids[key], field_totals) for key, field_totals
+                in totals.fields.items() if key in ids]
+        if not fields:
+            return
+
+        qn = connection.ops.quote_name
+        pk = qn('id')
+        assignments, params = [], []
+        for name, index in (('count', 0), ('total', 1)):
+            column = qn(name)
+            assignments.append('%s = %s + CASE %s %s ELSE 0 END' % (column,
+                column, pk, ' '.join(['WHEN %s THEN %s'] * len(fields))))
+            for aggregate_id, field_totals in fields:
+                params.extend([aggregate_id, field_totals[index]])
+
+        # Lower the minimum and raise the maximum where the new values pass
+        # them
+        for name, index, compare in (('minimum', 2, '>'), ('maximum', 3, '<')):
+            column = qn(name)
+            bounded = [(aggregate_id, field_totals[index]) for aggregate_id,
+                    field_totals in fields if field_totals[index] is not None]
+            if not bounded:
+                continue
+            when = 'WHEN %s = %%s AND (%s IS NULL OR %s %s %%s) THEN %%s' % (
+                    pk, column, column, compare)
+            assignments.append('%s = CASE %s ELSE %s END' % (column,
+                ' '.join([when] * len(bounded)), column))
+            for aggregate_id, value in bounded:
+                params.extend([aggregate_id, value, value])
+
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(self.model._meta.db_table), ', '.join(assignments), pk,
+            ', '.join(['%s'] * len(fields))),
+            params + [aggregate_id for aggregate_id, field_totals in fields])
+
+        for aggregate_id, field_totals in fields:
+            for start, count in field_totals[4].items():
+                AggregateBucket.objects.add(aggregate_id, start, count)
+        transaction.set_dirty()
+
+
+class AggregateBucketManager(models.Manager):
+    def add(self, aggregate_id, start, count):
+        """
+        Adds count to a histogram bucket, inserting it only if there's no
+        bucket to UPDATE yet.
+        """
+        rows = self.filter(aggregate=aggregate_id, start=start)
+        if rows.update(count=F('count') + count):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(aggregate_id=aggregate_id, start=start, count=count)
+        except IntegrityError:
+            # Inserted by a concurrent submission since the UPDATE
+            transaction.savepoint_rollback(sid)
+            rows.update(count=F('count') + count)
+        else:
+            transaction.savepoint_commit(sid)
+
+
+class FieldAggregate(models.Model):
+    """
+    Running totals of the answers to a UIField, kept up to date as
+    Submissions are recorded. What total, minimum and maximum hold depends on
+    the field's kind: for Boolean fields, total is the number of True answers.
+    Answers are totalled separately for each kind the field has had, as
+    visitors can still submit versions from before it changed.
+    """
+    uifield = models.ForeignKey(UIField, editable=False)
+    kind = models.CharField(max_length=1, editable=False)
+    count = models.PositiveIntegerField(default=0)
+    total = models.BigIntegerField(default=0)
+    minimum = models.BigIntegerField(null=True)
+    maximum = models.BigIntegerField(null=True)
+
+    objects = FieldAggregateManager()
+
+    class Meta:
+        unique_together = ('uifield', 'kind')
+
+    def __unicode__(self):
+        return 'FieldAggregate for "%s"' % self.uifield.label
+
+    def get_mean(self):
+        if self.count:
+            return float(self.total) / self.count
+        return None
+
+
+class AggregateBucket(models.Model):
+    """
+    The number of answers to a UIField that fall in the histogram bucket
+    starting at start. For Choice fields, start is the position of a choice.
+    """
+    aggregate = models.ForeignKey(FieldAggregate, editable=False)
+    start = models.BigIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    objects = AggregateBucketManager()
+
+    class Meta:
+        unique_together = ('aggregate', 'start')
+
+
+
+class QueuedEmailManager(models.Manager):
+    def due(self):
+        """ Returns the queued emails that are ready for a delivery attempt """
+        return self.filter(sent__isnull=True, failed=False,
+                next_attempt__lte=datetime.now()).order_by('next_attempt')
+
+
+class QueuedEmail(models.Model):
+    """
+    An outgoing email waiting to be delivered by the send_queued_email
+    management command. Delivery failures are recorded here and retried with
+    an increasing delay instead of being raised during the request.
+    """
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=255)
+    recipients = models.TextField(help_text='Comma-separated addresses')
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=datetime.now, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    sent = models.DateTimeField(null=True, blank=True, db_index=True)
+    failed = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True)
+
+    objects = QueuedEmailManager()
+
+    def __unicode__(self):
+        return 'QueuedEmail "%s" to %s' % (self.subject, self.recipients)
+
+    def get_recipient_list(self):
+        return [email.strip() for email in self.recipients.split(',')]
+
+
+class PendingNotification(models.Model):
+    """
+    The results of someone filling out a UIForm, as returned by
+    PreviewForm.describe(), waiting to be sent in the creator's next digest.
+    Only kept for UIForms that don't notify immediately.
+    """
+    uiform = models.ForeignKey(UIForm, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    results = models.TextField(editable=False)
+
+    def __unicode__(self):
+        return 'PendingNotification for "%s" at %s' % (self.uiform.label,
+                self.created)
+
+    def get_results(self):
+        return simplejson.loads(self.results)
+
+
 
 class UIFormForm(forms.ModelForm):
     """
@@ -113,26 +1138,68 @@ class UIFormForm(forms.ModelForm):
     label = forms.CharField(max_length=140, initial='My New UIForm')
     description = forms.CharField(widget=forms.Textarea, 
             initial='A brief description of this form...')
+    # Left out, these keep the UIForm's current settings
+    notification_policy = forms.ChoiceField(required=False,
+            choices=UIForm.notification_policies, initial=NOTIFY_IMMEDIATE)
+    notification_minutes = forms.IntegerField(required=False, min_value=1,
+            initial=60, help_text='Minutes between batched digests')
 
     class Meta:
         model = UIForm
         # User is automatically assigned
         exclude = ('creator',) 
 
+    def clean_notification_policy(self):
+        return (self.cleaned_data['notification_policy'] or
+                self.instance.notification_policy)
+
+    def clean_notification_minutes(self):
+        minutes = self.cleaned_data['notification_minutes']
+        if minutes is None:
+            return self.instance.notification_minutes
+        return minutes
+
     def clean_label(self):
-        """ Checks to make sure labels are unique per user """
+        """
+        Checks to make sure labels are unique per user. This is only a
+        friendly error: two forms created at once can still share a label,
+        but never a slug.
+        """
         label = self.cleaned_data['label']
-        creator = self.instance.creator
+        creator_id = self.instance.creator_id
         id = getattr(self.instance, 'id', None)
-        query = UIForm.objects.filter(label=label, creator=creator)
+        query = UIForm.objects.filter(creator=creator_id, label=label)
         if id:
             # Don't count this UIForm as a conflict when updating
             query = query.exclude(id=id)
-        if query.count():
+        if query.exists():
             raise forms.ValidationError('You already have a form with this label!')
         return label
 
 
+class SubmissionImportForm(forms.Form):
+    """
+    Form for uploading a JSON lines or CSV file of responses to a UIForm.
+    """
+    file = forms.FileField()
+
+    def clean_file(self):
+        file = self.cleaned_data['file']
+        if file.size > IMPORT_MAX_SIZE:
+            raise forms.ValidationError('Upload at most %d bytes at a time.' %
+                    IMPORT_MAX_SIZE)
+        return file
+
+
+class FieldImportForm(forms.Form):
+    """
+    Form for uploading a JSON or CSV file of UIFields.
+    """
+    file = forms.FileField()
+    replace = forms.BooleanField(required=False,
+            help_text='Delete fields that are not in the file')
+
+
 class BaseUIFieldFormSet(forms.models.BaseInlineFormSet):
     """
     Formset for adding UIFields inline on the UIForm update page.
@@ -145,35 +1212,171 @@ class BaseUIFieldFormSet(forms.models.BaseInlineFormSet):
             delete_field = form.fields[forms.formsets.DELETION_FIELD_NAME]
             delete_field.widget = forms.widgets.HiddenInput()
 
+    @batched_field_updates()
+    def save(self, commit=True):
+        """ Saves the UIFields, touching the parent UIForm only once """
+        return super(BaseUIFieldFormSet, self).save(commit)
+
 
 class PreviewForm(forms.Form):
     """ 
-    Dynamic form class that builds a custom form from the fields of a
-    UIForm and its UIFields.
-    """
-    def __init__(self, uiform, *args, **kwargs):
-        super(PreviewForm, self).__init__(*args, **kwargs)
-
-        # Build the set of fields dynamically from UIFields
-        for uifield in uiform.uifield_set.all():
-            if uifield.kind == 'B':
-                field = forms.BooleanField(label=uifield.label, 
-                        help_text=uifield.description)
-            elif uifield.kind == 'I':
-                field = forms.IntegerField(label=uifield.label, 
-                        help_text=uifield.description)
-            else: # Ignore unknown fields
-                continue
-            self.fields['uifield_%d_question' % uifield.id] = field
+    Base class for the dynamic forms built from the fields of a UIForm and its
+    UIFields. Use compile_preview_form() to get the subclass for a UIForm.
+    """
+    # Maps field names to UIField ids
+    uifield_ids = {}
+
+    # The CompiledUIFields, in order
+    compiled_fields = ()
+
+    # Maps UIField ids (as strings) and labels to CompiledUIFields
+    field_keys = {}
+
+    @classmethod
+    def validate(cls, data):
+        """
+        Checks submitted data (such as request.POST) in one pass over the
+        compiled validators, without creating a form. Returns a pair of
+        ({UIField id: answer}, {field name: error messages}); the answers are
+        only complete if there are no errors.
+        """
+        answers, errors = {}, {}
+        for field in cls.compiled_fields:
+            widget = cls.base_fields[field.name].widget
+            try:
+                answers[field.id] = field.validate(
+                        widget.value_from_datadict(data, None, field.name))
+            except ValidationError, e:
+                errors[field.name] = e.messages
+        return answers, errors
+
+    @classmethod
+    def validate_values(cls, values):
+        """
+        Like validate(), for a dict of raw answers keyed by UIField id or
+        label, as read from a bulk submission file. Fields that aren't in the
+        dict are unanswered. Errors are keyed by UIField label, or by the key
+        for keys that don't match a UIField.
+        """
+        given, errors = {}, {}
+        for key, value in values.items():
+            field = cls.field_keys.get(key)
+            if field is None:
+                errors[key] = [u'Unknown field.']
+            else:
+                given[field.id] = value
+
+        answers = {}
+        for field in cls.compiled_fields:
+            try:
+                answers[field.id] = field.validate(given.get(field.id))
+            except ValidationError, e:
+                errors[cls.base_fields[field.name].label] = e.messages
+        return answers, errors
+
+    @classmethod
+    def measure(cls, answers):
+        """
+        Returns {(UIField id, kind): (value, bucket)} for adding a dict of
+        answers to the FieldAggregates. Unanswered fields are left out.
+        """
+        return dict(((field.id, field.kind.code),
+                field.measure(answers[field.id]))
+                for field in cls.compiled_fields
+                if answers.get(field.id) is not None)
+
+    @classmethod
+    def describe(cls, answers):
+        """
+        Returns a list of {'label':UIField.label, 'answer':the answer} dicts
+        for a dict of answers.
+        """
+        return [{
+            'label': cls.base_fields[field.name].label,
+            'answer': answers.get(field.id),
+        } for field in cls.compiled_fields]
 
     def get_results(self):
         """
         Returns a list of {'label':UIField.label, 'answer':the answer} dicts.
         """
-        return [{
-            'label': self.fields[field].label,
-            'answer': self.cleaned_data[field]
-        } for field in self.fields]
+        return self.describe(self.get_answers())
+
+    def get_answers(self):
+        """
+        Returns a dict of {UIField id: the answer}.
+        """
+        return dict((self.uifield_ids[field], self.cleaned_data[field])
+                for field in self.fields)
+
+
+# Compiled PreviewForm subclasses, keyed by UIForm id. Only the class for the
+# most recent version of each UIForm is kept.
+_preview_form_classes = {}
+
+def preview_form_cache_key(uiform):
+    """
+    Returns the cache key for the compiled fields of a UIForm. Includes the
+    last_updated timestamp, so saving a UIField (which touches the parent
+    UIForm) invalidates it.
+    """
+    return 'uiforms:preview_spec:%d:%s' % (uiform.id,
+            uiform.last_updated.isoformat())
+
+def build_preview_form_class(spec):
+    """
+    Creates a PreviewForm subclass from a list of (id, kind, label,
+    description, choices, minimum, maximum) tuples describing UIFields.
+    Each UIField's validator is compiled here, once per version of the UIForm.
+    """
+    attrs = {'uifield_ids': {}, 'compiled_fields': [], 'field_keys': {}}
+    for id, kind, label, description, choices, minimum, maximum in spec:
+        field = compile_uifield(id, kind, choices, minimum, maximum)
+        if field is None: # Ignore unknown fields
+            continue
+        attrs[field.name] = field.form_field(label, description)
+        attrs['uifield_ids'][field.name] = id
+        attrs['compiled_fields'].append(field)
+        attrs['field_keys'][str(id)] = field
+        attrs['field_keys'].setdefault(label, field)
+    return type('CompiledPreviewForm', (PreviewForm,), attrs)
+
+def compile_preview_form(uiform):
+    """
+    Returns the PreviewForm subclass for the current, possibly unpublished,
+    UIFields of a UIForm.
+
+    The field spec is shared between processes through the cache backend, and
+    the generated class is kept in-process, so a warm form costs no queries.
+    """
+    key = preview_form_cache_key(uiform)
+    cached_key, form_class = _preview_form_classes.get(uiform.id, (None, None))
+    if cached_key == key:
+        return form_class
+
+    spec = cache.get(key)
+    if spec is None:
+        spec = uiform.get_field_spec()
+        cache.set(key, spec)
+
+    form_class = build_preview_form_class(spec)
+    _preview_form_classes[uiform.id] = (key, form_class)
+    return form_class
+
+
+# Compiled PreviewForm subclasses, keyed by SchemaVersion id
+_version_form_classes = LRUCache(VERSION_CACHE_SIZE)
+
+def compile_version_form(version):
+    """
+    Returns the PreviewForm subclass for a SchemaVersion. Versions never
+    change, so the class is built once per process and kept until evicted.
+    """
+    form_class = _version_form_classes.get(version.id)
+    if form_class is None:
+        form_class = build_preview_form_class(version.get_schema()['fields'])
+        _version_form_classes.set(version.id, form_class, VERSION_TIMEOUT)
+    return form_class
 
 
 
@@ -0,0 +1,128 @@
+"""
+In-process publish/subscribe for UIForm changes, used to wake up long-polling
+clients as soon as a UIForm is saved instead of having them poll the database.
+
+Versions are also written to the cache backend, which stands in for a broker
+when the site runs in several processes: waiters check it every
+POLL_INTERVAL seconds, which costs a cache read rather than a query.
+
+Each waiting request holds a worker, so at most UIFORMS_WATCH_MAX_WAITERS
+may wait at once in each process, and only the versions of UIForms that
+someone is waiting on are kept in memory.
+"""
+from django.core.cache import cache
+from django.conf import settings
+from serializers import timestamp
+import threading
+import time
+
+# Seconds between cache checks while waiting for a change
+POLL_INTERVAL = getattr(settings, 'UIFORMS_WATCH_POLL_INTERVAL', 2)
+
+# Most requests waiting for changes at once in each process
+MAX_WAITERS = getattr(settings, 'UIFORMS_WATCH_MAX_WAITERS', 20)
+
+# Version published when a UIForm is deleted
+DELETED = 0
+
+CACHE_TIMEOUT = 24 * 60 * 60
+
+def version_cache_key(uiform_id):
+    return 'uiforms:version:%d' % uiform_id
+
+def get_version(uiform):
+    """ Returns the version of a UIForm, as a unix timestamp """
+    return timestamp(uiform.last_updated)
+
+
+class TooManyWaiters(Exception):
+    pass
+
+
+class ChangeNotifier(object):
+    """
+    Lets threads block until the version of a UIForm differs from the one
+    they know about, keeping the latest version of each UIForm that a thread
+    is waiting on.
+    """
+    def __init__(self, max_waiters=MAX_WAITERS):
+        self.max_waiters = max_waiters
+        self.condition = threading.Condition()
+        self.versions = {}
+        # {UIForm id: number of threads waiting on it}
+        self.waiting = {}
+        self.waiters = 0
+
+    def publish(self, uiform_id, version):
+        cache.set(version_cache_key(uiform_id), version, CACHE_TIMEOUT)
+        self.condition.acquire()
+        try:
+            # Anyone who starts waiting later reads it from the cache
+            if uiform_id in self.waiting:
+                self.versions[uiform_id] = version
+                self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def current(self, uiform_id, known):
+        """
+        Returns the latest published version of a UIForm, checking the cache
+        if no newer version has been published in this process.
+        """
+        version = self.versions.get(uiform_id)
+        if version is None or version == known:
+            version = cache.get(version_cache_key(uiform_id))
+        return version
+
+    def wait(self, uiform_id, known, timeout):
+        """
+        Blocks until a version other than known is published for a UIForm,
+        and returns it. Returns None if nothing changed before the timeout.
+        Raises TooManyWaiters if it would have to wait while max_waiters
+        threads already are.
+        """
+        version = self.current(uiform_id, known)
+        if version is not None and version != known:
+            return version
+
+        self.condition.acquire()
+        try:
+            if self.waiters >= self.max_waiters:
+                raise TooManyWaiters('%d requests waiting' % self.waiters)
+            self.waiters += 1
+            self.waiting[uiform_id] = self.waiting.get(uiform_id, 0) + 1
+        finally:
+            self.condition.release()
+
+        try:
+            deadline = time.time() + timeout
+            while True:
+                version = self.current(uiform_id, known)
+                if version is not None and version != known:
+                    return version
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+
+                self.condition.acquire()
+                try:
+                    # Skip the wait if a publish happened since the check
+                    # above
+                    if self.versions.get(uiform_id, known) == known:
+                        self.condition.wait(min(remaining, POLL_INTERVAL))
+                finally:
+                    self.condition.release()
+        finally:
+            self.condition.acquire()
+            try:
+                self.waiters -= 1
+                self.waiting[uiform_id] -= 1
+                if not self.waiting[uiform_id]:
+                    del self.waiting[uiform_id]
+                    self.versions.pop(uiform_id, None)
+            finally:
+                self.condition.release()
+
+
+notifier = ChangeNotifier()
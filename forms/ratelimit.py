@@ -0,0 +1,159 @@
+"""
+Token bucket rate limiting for anonymous form submissions.
+
+Each (share token, client IP) pair gets a bucket of BURST submissions that
+refills at RATE submissions per second. Requests for strings that can't be
+share tokens aren't counted, as the view rejects them without any lookup.
+The default backend keeps buckets in process memory, in a dict that requests
+read and write without taking a lock; set UIFORMS_RATE_LIMIT_BACKEND =
+'cache' to share them between processes through the cache backend instead.
+"""
+from django.core.cache import cache
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.functional import wraps
+import threading
+import time
+
+from tokens import TOKEN_RE
+
+RATE = getattr(settings, 'UIFORMS_SUBMIT_RATE', 0.2)
+BURST = getattr(settings, 'UIFORMS_SUBMIT_BURST', 5)
+BACKEND = getattr(settings, 'UIFORMS_RATE_LIMIT_BACKEND', 'local')
+
+# Buckets kept in process before the least recently used are dropped
+MAX_BUCKETS = getattr(settings, 'UIFORMS_RATE_LIMIT_MAX_BUCKETS', 100000)
+
+# Seconds between sweeps for buckets that have refilled
+PRUNE_INTERVAL = getattr(settings, 'UIFORMS_RATE_LIMIT_PRUNE_INTERVAL', 60)
+
+
+class LocalRateLimiter(object):
+    """
+    Keeps token buckets in a dict of {key: (tokens, last request time)}.
+    Requests don't take a lock: each reads and replaces its bucket with
+    single dict operations, so concurrent requests for the same bucket can
+    race, which at worst lets an extra request through, and the allowed and
+    limited counts can miss a few requests.
+
+    A refilled bucket counts the same as a missing one, so every
+    prune_interval seconds, or once there are more than max_buckets, one
+    request sweeps the refilled ones out. If that isn't enough, the least
+    recently used are dropped too, down to three quarters of max_buckets so
+    a flood of new keys doesn't sort the buckets on every request.
+    """
+    def __init__(self, rate, burst, max_buckets=MAX_BUCKETS,
+            prune_interval=PRUNE_INTERVAL):
+        self.rate = rate
+        self.burst = burst
+        self.max_buckets = max_buckets
+        self.prune_interval = prune_interval
+        self.buckets = {}
+        self.next_prune = time.time() + prune_interval
+        # Only held while pruning, and never waited for
+        self.pruning = threading.Lock()
+        self.allowed = 0
+        self.limited = 0
+
+    def allow(self, key):
+        now = time.time()
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+            self.allowed += 1
+        else:
+            self.limited += 1
+        self.buckets[key] = (tokens, now)
+
+        if now >= self.next_prune or len(self.buckets) > self.max_buckets:
+            self.prune(now)
+        return allowed
+
+    def prune(self, now):
+        """
+        Drops the buckets that have refilled, then the least recently used
+        if there are still too many. Returns at once if another thread is
+        already pruning.
+        """
+        if not self.pruning.acquire(False):
+            return
+        try:
+            self.next_prune = now + self.prune_interval
+            # items() is a copy, so other threads can keep changing the dict
+            for key, (tokens, last) in self.buckets.items():
+                if tokens + (now - last) * self.rate >= self.burst:
+                    self.buckets.pop(key, None)
+
+            if len(self.buckets) > self.max_buckets:
+                buckets = sorted(self.buckets.items(),
+                        key=lambda item: item[1][1])
+                for key, bucket in buckets[:len(buckets) -
+                        self.max_buckets * 3 // 4]:
+                    self.buckets.pop(key, None)
+        finally:
+            self.pruning.release()
+
+    def metrics(self):
+        return {
+            'backend': 'local',
+            'allowed': self.allowed,
+            'limited': self.limited,
+            'buckets': len(self.buckets),
+        }
+
+
+class CacheRateLimiter(LocalRateLimiter):
+    """
+    Approximates a token bucket with counters in the cache backend, shared
+    by every process: each key may make BURST requests per window of
+    BURST / RATE seconds.
+    """
+    def allow(self, key):
+        window = max(1, int(self.burst / self.rate))
+        cache_key = 'uiforms:ratelimit:%s:%d' % (key, time.time() // window)
+        cache.add(cache_key, 0, window)
+        try:
+            count = cache.incr(cache_key)
+        except ValueError:
+            # Expired between add() and incr()
+            count = 1
+
+        if count > self.burst:
+            self.limited += 1
+            return False
+        self.allowed += 1
+        return True
+
+    def metrics(self):
+        return {
+            'backend': 'cache',
+            'allowed': self.allowed,
+            'limited': self.limited,
+        }
+
+
+if BACKEND == 'cache':
+    limiter = CacheRateLimiter(RATE, BURST)
+else:
+    limiter = LocalRateLimiter(RATE, BURST)
+
+
+def limit_submissions(view):
+    """
+    Decorator for views taking a token argument that answers POSTs over the
+    rate limit with a 429, before the view does any work.
+    """
+    def wrapper(request, *args, **kw):
+        token = kw.get('token')
+        if request.method == 'POST' and token and TOKEN_RE.match(token):
+            key = '%s:%s' % (token, request.META.get('REMOTE_ADDR'))
+            if not limiter.allow(key):
+                response = HttpResponse('Too many submissions, please try '
+                        'again later.', status=429, mimetype='text/plain')
+                response['Retry-After'] = str(int(1 / limiter.rate) or 1)
+                return response
+        return view(request, *args, **kw)
+    return wraps(view)(wrapper)
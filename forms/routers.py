@@ -0,0 +1,87 @@
+"""
+Sends reads from some views to read replicas of the database.
+
+Views marked with @use_replica read the forms app's tables from one of the
+databases listed in UIFORMS_READ_DATABASES when handling a GET. Everything
+else, including sessions and users, and every write uses the default
+database. To turn it on, add the replica to DATABASES and
+set:
+
+    DATABASE_ROUTERS = ['forms.routers.ReplicaRouter']
+    UIFORMS_READ_DATABASES = ('replica',)
+
+and add ReplicaMiddleware to MIDDLEWARE_CLASSES. After a visitor POSTs
+anything, the middleware sets a cookie that keeps their reads on the default
+database for UIFORMS_REPLICA_LAG seconds, so they see their own writes.
+
+To try it locally, point 'replica' at a second SQLite file, run
+"syncdb --database=replica", and copy the default database file over it
+whenever it should catch up.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.functional import wraps
+import random
+import threading
+
+# Aliases of the databases that can serve reads for @use_replica views
+READ_DATABASES = tuple(getattr(settings, 'UIFORMS_READ_DATABASES', ()))
+
+# Longest expected replication delay, in seconds
+REPLICA_LAG = getattr(settings, 'UIFORMS_REPLICA_LAG', 10)
+
+# Cookie set after a write, while the visitor's reads should use the primary
+PRIMARY_COOKIE = 'uiforms_primary'
+
+# Views that may read from a replica only do so for these methods
+READ_METHODS = ('GET', 'HEAD')
+
+_state = threading.local()
+
+def get_read_database():
+    """ Returns the alias that reads in the current thread should use """
+    return getattr(_state, 'database', None) or DEFAULT_DB_ALIAS
+
+
+# Only models in this app are read from replicas. A lagging replica's
+# sessions and users would log visitors out.
+REPLICA_APP_LABEL = 'forms'
+
+class ReplicaRouter(object):
+    """
+    Database router for READ_DATABASES. Replicas hold the same tables as the
+    default database, so relations and syncdb are allowed everywhere.
+    """
+    def db_for_read(self, model, **hints):
+        # Always choose, so instances loaded from a replica and cached don't
+        # send later reads back to it
+        if model._meta.app_label == REPLICA_APP_LABEL:
+            return get_read_database()
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_syncdb(self, db, model):
+        return None
+
+
+def use_replica(view):
+    """
+    Marks a view as safe to serve from a replica. GETs read from a random
+    one of READ_DATABASES, unless the visitor has written recently.
+    """
+    def wrapper(request, *args, **kwargs):
+        if (not READ_DATABASES or request.method not in READ_METHODS
+                or PRIMARY_COOKIE in request.COOKIES):
+            return view(request, *args, **kwargs)
+
+        _state.database = random.choice(READ_DATABASES)
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            _state.database = None
+    return wraps(view)(wrapper)
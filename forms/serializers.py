@@ -0,0 +1,83 @@
+"""
+Lightweight JSON serialization for UIForms.
+
+UIForms are copied into a small __slots__ class, either from model instances
+or from values() rows, and URLs are built by filling in a pattern that is
+reversed once per process instead of calling reverse() for every UIForm.
+"""
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+import time
+
+# Placeholder reversed in place of the URL argument, matching [\w-]+
+PLACEHOLDER = 'uiformsarg0'
+
+_url_patterns = {}
+
+def url_pattern(name):
+    """
+    Returns a %-format string for the URL with the given name, so that
+    url_pattern(name) % slug == reverse(name, args=[slug]).
+    """
+    pattern = _url_patterns.get(name)
+    if pattern is None:
+        url = reverse(name, args=[PLACEHOLDER]).replace('%', '%%')
+        pattern = _url_patterns[name] = url.replace(PLACEHOLDER, '%s')
+    return pattern
+
+def timestamp(value):
+    """ Returns a datetime as a unix timestamp, like the "U" date format """
+    return int(time.mktime(value.timetuple()))
+
+
+class UIFormData(object):
+    __slots__ = ('id', 'slug', 'label', 'description', 'creator',
+            'last_updated')
+
+    # Columns to fetch with values() for from_values()
+    values_fields = ('id', 'slug', 'label', 'description', 'last_updated')
+
+    def __init__(self, id, slug, label, description, creator, last_updated):
+        self.id = id
+        self.slug = slug
+        self.label = label
+        self.description = description
+        self.creator = creator
+        self.last_updated = last_updated
+
+    @classmethod
+    def from_model(cls, uiform, creator=None):
+        """
+        Pass the creator's username if it's already known, to avoid loading
+        uiform.creator.
+        """
+        if creator is None:
+            creator = uiform.creator.username
+        return cls(uiform.id, uiform.slug, uiform.label, uiform.description,
+                creator, uiform.last_updated)
+
+    @classmethod
+    def from_values(cls, row, creator):
+        """ Builds a UIFormData from a values(*values_fields) row """
+        return cls(row['id'], row['slug'], row['label'], row['description'],
+                creator, row['last_updated'])
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'slug': self.slug,
+            'label': self.label,
+            'description': self.description,
+            'creator': self.creator,
+            'last_updated': timestamp(self.last_updated),
+            'url': url_pattern('preview_uiform') % self.slug,
+        }
+
+
+def dumps(data):
+    """
+    Serializes a data object, or a list of them, to a JSON string.
+    """
+    if isinstance(data, (list, tuple)):
+        return simplejson.dumps([item.as_dict() for item in data])
+    return simplejson.dumps(data.as_dict())
@@ -0,0 +1,95 @@
+"""
+Static HTML snapshots of the blank pages of shared UIForms.
+
+When UIFORMS_SNAPSHOT_ROOT is set, the page at each URLToken's URL is
+written to UIFORMS_SNAPSHOT_ROOT/<url path>/index.html whenever the UIForm
+is saved or published, and removed when the form or token is deleted. The
+web server can then answer plain GETs itself and leave POSTs and requests
+with a query string to Django, e.g. with Apache:
+
+    RewriteCond %{REQUEST_METHOD} =GET
+    RewriteCond %{QUERY_STRING} ^$
+    RewriteCond /path/to/snapshots%{REQUEST_URI}index.html -f
+    RewriteRule ^ /path/to/snapshots%{REQUEST_URI}index.html [L]
+
+Snapshots can't contain a per-visitor CSRF token, so view_token_uiform is
+exempt from CSRF checks in this mode.
+"""
+from django.conf import settings
+from django.http import HttpRequest
+from django.contrib.auth.models import AnonymousUser
+import shutil
+import os
+
+SNAPSHOT_ROOT = getattr(settings, 'UIFORMS_SNAPSHOT_ROOT', None)
+
+
+def snapshot_dir(url):
+    return os.path.join(SNAPSHOT_ROOT, url.strip('/'))
+
+def snapshot_request():
+    """ Returns a request like one from an anonymous visitor """
+    request = HttpRequest()
+    request.method = 'GET'
+    request.user = AnonymousUser()
+    return request
+
+
+def write_snapshot(uiform):
+    """
+    Writes the blank page of a shared UIForm. Does nothing if the UIForm
+    hasn't been shared or published.
+    """
+    from models import URLToken
+    from utils import render_uiform_page
+
+    if uiform.version_id is None:
+        return
+    try:
+        urltoken = URLToken.objects.get(uiform=uiform)
+    except URLToken.DoesNotExist:
+        return
+
+    version = uiform.get_version()
+    html = render_uiform_page(snapshot_request(), uiform,
+            version.get_form_class()(), version)
+
+    # Write to a temporary file first, so the web server never sees half a page
+    directory = snapshot_dir(urltoken.get_absolute_url())
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, 'index.html')
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    output = open(temp_path, 'w')
+    try:
+        output.write(html.encode('utf-8'))
+    finally:
+        output.close()
+    os.rename(temp_path, path)
+
+def delete_snapshot(urltoken):
+    directory = snapshot_dir(urltoken.get_absolute_url())
+    shutil.rmtree(directory, True)
+
+    # Clean up the directories above it that are now empty
+    directory = os.path.dirname(directory)
+    while directory.startswith(SNAPSHOT_ROOT.rstrip('/') + '/'):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+
+def snapshot_uiform(uiform_id):
+    """
+    Writes the snapshot of a UIForm by id, if it still exists. Used by
+    rebuild_snapshots worker processes.
+    """
+    from models import UIForm
+
+    try:
+        write_snapshot(UIForm.objects.get(id=uiform_id))
+    except UIForm.DoesNotExist:
+        pass
+    return uiform_id
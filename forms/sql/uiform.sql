@@ -0,0 +1,3 @@
+-- Index for listing a user's UIForms. Lookups by (creator_id, slug) use the
+-- unique index from UIForm.Meta.unique_together.
+CREATE INDEX forms_uiform_creator_last_updated ON forms_uiform (creator_id, last_updated);
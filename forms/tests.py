@@ -0,0 +1,762 @@
+"""
+Query count regression tests for every view in forms/views.py, and a test
+of concurrent creates for create_uiform.
+
+Each count includes the session and auth_user lookups that a logged in
+request makes. When a count changes, the failure lists the queries that
+were run, so a new N+1 is easy to spot.
+
+Run them with:
+
+    ./manage.py test forms --settings=test_settings
+
+test_settings keeps the SQLite test database in a file. Tests that use
+several threads, each with its own connection, need that to share it, and
+they're skipped with a warning when the database is in memory.
+"""
+from __future__ import with_statement
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client
+from django.template import Template
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection, connections, transaction
+from django.core import mail
+from django.conf import settings
+from django.utils import simplejson
+from StringIO import StringIO
+from datetime import datetime, timedelta
+import warnings
+import re
+import tempfile
+import time
+import shutil
+import os
+
+from models import UIForm, UIField, URLToken, Submission, QueuedEmail, \
+        PendingNotification, NOTIFY_BATCHED, _schema_versions, \
+        _preview_form_classes, _version_form_classes
+from loadtest import CreateRace, LoadDriver, SubmitThroughput
+from notify import notifier, get_version
+from ratelimit import limiter, LocalRateLimiter
+from ingest import SubmissionIngester, IngestFull, recover_spool, dump_entry, \
+        SPOOL_SUFFIX, REJECTED_NAME
+from tokens import resolver as token_resolver
+from utils import rebuild_aggregates, send_due_digests, deliver_queued_mail
+from middleware import InstrumentationMiddleware
+from routers import PRIMARY_COOKIE
+import middleware
+import routers
+
+
+def reset_caches():
+    """
+    Empties the caches kept in this process and in the cache backend. Ids are
+    reused once a test's transaction is rolled back, so entries cached by
+    one test could otherwise turn up in the next.
+    """
+    cache.clear()
+    for lru in (_schema_versions, _version_form_classes,
+            token_resolver.tokens, getattr(limiter, 'buckets', None)):
+        if lru is not None:
+            lru.clear()
+    _preview_form_classes.clear()
+
+def threads_share_database(test):
+    """
+    Returns whether threads, which each open their own connection, share
+    the test database. They don't with an in-memory SQLite database, so
+    warns that the test is skipped, as Django 1.2 can't mark it skipped.
+    """
+    settings_dict = connection.settings_dict
+    if (settings_dict['ENGINE'].endswith('sqlite3') and
+            settings_dict.get('TEST_NAME') in (None, '', ':memory:')):
+        warnings.warn('Skipped %s, which needs the test database in a file; '
+                'run the tests with --settings=test_settings' % test.id())
+        return False
+    return True
+
+def replica_configured(test):
+    """
+    Returns whether reads can be routed to a 'replica' database mirroring
+    the test database, as with test_settings, or warns that the test is
+    skipped.
+    """
+    if ('replica' not in settings.DATABASES or 'forms.routers.ReplicaRouter'
+            not in settings.DATABASE_ROUTERS or
+            'forms.middleware.ReplicaMiddleware'
+            not in settings.MIDDLEWARE_CLASSES):
+        warnings.warn('Skipped %s, which needs a replica database and '
+                'ReplicaRouter; run the tests with --settings=test_settings'
+                % test.id())
+        return False
+    # An in-memory database can't be mirrored by another connection
+    return threads_share_database(test)
+
+
+class QueryCountTestCase(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.user = User.objects.create_user('bob', 'bob@example.com', 'bob')
+        self.uiform = UIForm.objects.create(label='Survey',
+                description='A survey', creator=self.user)
+        for label, kind, choices in (('Agree', 'B', ''), ('Age', 'I', ''),
+                ('Colour', 'C', 'red\ngreen')):
+            UIField.objects.create(uiform=self.uiform, label=label, kind=kind,
+                    choices=choices)
+        self.uiform = UIForm.objects.get(id=self.uiform.id)
+        self.uiform.publish()
+        self.token = URLToken.objects.create(uiform=self.uiform)
+        self.fields = dict((field.label, field.id)
+                for field in self.uiform.uifield_set.all())
+
+        self.client.login(username='bob', password='bob')
+        # Token visitors aren't logged in
+        self.visitor = Client()
+
+    def assertQueries(self, num, func, *args, **kwargs):
+        """
+        Calls func, and fails unless it ran exactly num queries. Returns
+        what func returned.
+        """
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            settings.DEBUG = old_debug
+        queries = [query['sql'] for query in connection.queries]
+        self.assertEqual(len(queries), num, '%d queries run, expected %d:\n%s'
+                % (len(queries), num, '\n'.join(queries)))
+        return result
+
+    def get(self, num, url, data={}, status=200, client=None, **extra):
+        """
+        GETs url with the test client, or another client, checking the
+        number of queries and the status code. Streamed content is read
+        within the count, and kept so it can be read again.
+        """
+        def get():
+            response = (client or self.client).get(url, data, **extra)
+            response.content = response.content
+            return response
+        response = self.assertQueries(num, get)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def post(self, num, url, data={}, status=302, client=None, **extra):
+        response = self.assertQueries(num, (client or self.client).post, url,
+                data, **extra)
+        self.assertEqual(response.status_code, status)
+        return response
+
+    def answers(self, **values):
+        """ Returns POST data for the fixture's fields, keyed by label """
+        data = {'schema_version': self.uiform.version_id}
+        for label, value in values.items():
+            data['uifield_%d_question' % self.fields[label]] = value
+        return data
+
+    def record(self, count):
+        """ Stores count submissions to the fixture """
+        version = self.uiform.get_version()
+        for n in range(count):
+            Submission.objects.record(version, {self.fields['Agree']: True,
+                self.fields['Age']: n, self.fields['Colour']: 'red'})
+
+
+class UIFormViewTest(QueryCountTestCase):
+    def test_landing_page(self):
+        self.get(2, reverse('landing_page'), status=302)
+
+    def test_list_uiforms(self):
+        for n in range(5):
+            UIForm.objects.create(label='Form %d' % n, creator=self.user)
+        self.get(4, reverse('list_uiforms'))
+
+    def test_list_uiforms_json(self):
+        for n in range(5):
+            UIForm.objects.create(label='Form %d' % n, creator=self.user)
+        response = self.get(3, reverse('list_uiforms_json'))
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_create_uiform(self):
+        self.get(3, reverse('create_uiform'))
+        self.post(6, reverse('create_uiform'), {'label': 'Poll',
+                'description': 'A poll'})
+        self.assertEqual(UIForm.objects.filter(creator=self.user).count(), 2)
+
+    def test_update_uiform(self):
+        url = reverse('update_uiform', args=[self.uiform.slug])
+        self.get(5, url)
+        self.post(10, url, {'label': 'Renamed', 'description': 'Changed'})
+
+    def test_publish_uiform(self):
+        url = reverse('publish_uiform', args=[self.uiform.slug])
+        # Nothing has changed since the fixture was published
+        self.post(6, url)
+        UIField.objects.create(uiform=self.uiform, label='Name', kind='T')
+        self.post(14, url)
+
+    def test_delete_uiform(self):
+        url = reverse('delete_uiform', args=[self.uiform.slug])
+        self.get(4, url)
+        self.post(27, url)
+        self.assertFalse(UIForm.objects.filter(id=self.uiform.id).exists())
+
+    def test_preview_uiform(self):
+        self.get(5, reverse('preview_uiform', args=[self.uiform.slug]))
+
+    def test_share_uiform(self):
+        url = reverse('share_uiform', args=[self.uiform.slug])
+        self.get(4, url)
+        self.post(8, url, {'email': 'alice@example.com', 'message': 'Hi'})
+
+
+class TokenViewTest(QueryCountTestCase):
+    def test_view_token_uiform(self):
+        url = self.token.get_absolute_url()
+        response = self.get(2, url, client=self.visitor)
+        for label in ('Agree', 'Age', 'Colour'):
+            self.assertContains(response, '<label for="id_uifield_%d_question">'
+                    '%s</label>' % (self.fields[label], label))
+        self.assertContains(response, 'name="schema_version" value="%d"'
+                % self.uiform.version_id)
+        # Cached since the first visit
+        self.assertEqual(self.get(0, url, client=self.visitor).content,
+                response.content)
+
+    def test_view_unpublished_uiform(self):
+        # Shared before sharing published forms, so the visit mustn't write
+        uiform = UIForm.objects.create(label='Legacy', creator=self.user)
+        url = URLToken.objects.create(uiform=uiform).get_absolute_url()
+        self.get(2, url, status=404, client=self.visitor)
+        call_command('publish_shared_uiforms', verbosity=0)
+        self.get(1, url, client=self.visitor)
+
+    def test_view_token_uiform_submit(self):
+        self.post(11, self.token.get_absolute_url(),
+                self.answers(Agree='on', Age='42', Colour='red'),
+                client=self.visitor)
+        submission = Submission.objects.get()
+        self.assertEqual(submission.version_id, self.uiform.version_id)
+        self.assertEqual(simplejson.loads(submission.answers), {
+            str(self.fields['Agree']): True,
+            str(self.fields['Age']): 42,
+            str(self.fields['Colour']): 'red',
+        })
+        email = QueuedEmail.objects.get()
+        self.assertEqual(email.recipients, 'bob@example.com')
+        self.assertTrue('Age: 42' in email.body)
+
+    def test_view_token_uiform_errors(self):
+        response = self.post(2, self.token.get_absolute_url(),
+                self.answers(Age='old', Colour='pink'), status=200,
+                client=self.visitor)
+        self.assertContains(response, 'Enter a whole number.')
+        self.assertContains(response, 'Select one of the available choices.')
+        self.assertEqual(Submission.objects.count(), 0)
+
+    def test_rate_limit(self):
+        url = self.token.get_absolute_url()
+        for n in range(limiter.burst):
+            self.visitor.post(url, {})
+        # Refused before any lookups
+        response = self.post(0, url, {}, status=429, client=self.visitor)
+        self.assertEqual(response['Retry-After'], '5')
+        # Counted per client address
+        self.post(0, url, {}, status=200, client=self.visitor,
+                REMOTE_ADDR='10.0.0.1')
+
+    def test_import_submissions(self):
+        rows = ['Agree,Age,Colour'] + ['true,%d,red' % n for n in range(50)]
+        upload = StringIO('\r\n'.join(rows + ['true,old,red']))
+        upload.name = 'responses.csv'
+        response = self.post(19, self.token.get_absolute_url() +
+                'submissions.csv', {'file': upload}, status=200)
+        self.assertContains(response, '"error_count": 1')
+        self.assertEqual(Submission.objects.count(), 50)
+
+
+class LocalRateLimiterTest(TestCase):
+    def test_allow(self):
+        limiter = LocalRateLimiter(rate=0.001, burst=2)
+        self.assertEqual([limiter.allow('a') for n in range(3)],
+                [True, True, False])
+        self.assertTrue(limiter.allow('b'))
+        self.assertEqual(limiter.metrics(), {'backend': 'local',
+            'allowed': 3, 'limited': 1, 'buckets': 2})
+
+    def test_prune(self):
+        # Buckets refill within a millisecond, and every request prunes
+        limiter = LocalRateLimiter(rate=1000, burst=1, prune_interval=0)
+        limiter.allow('a')
+        time.sleep(0.01)
+        limiter.allow('b')
+        self.assertEqual(limiter.buckets.keys(), ['b'])
+
+    def test_max_buckets(self):
+        limiter = LocalRateLimiter(rate=0.001, burst=1, max_buckets=8)
+        for n in range(20):
+            limiter.allow(str(n))
+        self.assertTrue(len(limiter.buckets) <= 8)
+        # The most recent are kept
+        self.assertFalse(limiter.allow('19'))
+
+
+class StatusViewTest(QueryCountTestCase):
+    def test_status_uiform(self):
+        url = reverse('status_uiform', args=[self.uiform.id])
+        response = self.get(4, url)
+        data = simplejson.loads(response.content)
+        self.assertEqual((data['id'], data['label'], data['creator']),
+                (self.uiform.id, 'Survey', 'bob'))
+        self.get(3, url, HTTP_IF_NONE_MATCH=response['ETag'], status=304)
+
+    def test_status_json_escaping(self):
+        # Quotes and newlines broke the old hand-built status JSON
+        label, description = 'Say "hi"\nthere', 'A \\ "quoted"\r\ndescription'
+        uiform = UIForm.objects.create(label=label, description=description,
+                creator=self.user)
+        for url, data in ((reverse('status_uiform', args=[uiform.id]), {}),
+                (reverse('batch_status_uiforms'), {'id': uiform.id}),
+                (reverse('list_uiforms_json'), {})):
+            results = simplejson.loads(self.client.get(url, data).content)
+            if isinstance(results, dict):
+                results = results.get('uiforms', [results])
+            result = [result for result in results
+                    if result['id'] == uiform.id][0]
+            self.assertEqual((result['label'], result['description']),
+                    (label, description))
+            self.assertEqual(result['url'], reverse('preview_uiform',
+                args=[uiform.slug]))
+
+    def test_batch_status_uiforms(self):
+        ids = [self.uiform.id] + [UIForm.objects.create(label='Form %d' % n,
+            creator=self.user).id for n in range(5)]
+        self.get(4, reverse('batch_status_uiforms'), {'id': ids})
+
+    def test_watch_uiform(self):
+        # A stale version returns at once
+        self.get(3, reverse('watch_uiform', args=[self.uiform.id]),
+                {'version': '0'})
+
+    def test_watch_uiform_busy(self):
+        # Past the cap, an up to date version returns at once
+        url = reverse('watch_uiform', args=[self.uiform.id])
+        old_max_waiters, notifier.max_waiters = notifier.max_waiters, 0
+        try:
+            response = self.get(3, url, {'version': get_version(self.uiform)},
+                    status=204)
+        finally:
+            notifier.max_waiters = old_max_waiters
+        self.assertTrue(response.has_header('Retry-After'))
+        # Nobody is waiting, so nothing is kept in memory
+        notifier.publish(self.uiform.id, 1)
+        self.assertFalse(self.uiform.id in notifier.versions)
+
+    def test_stats_uiform(self):
+        self.record(5)
+        response = self.get(6, reverse('stats_uiform', args=[self.uiform.id]))
+        stats = dict((field['label'], field)
+                for field in simplejson.loads(response.content)['fields'])
+        self.assertEqual((stats['Age']['count'], stats['Age']['sum']), (5, 10))
+        self.assertEqual(stats['Colour']['choices'], [['red', 5],
+            ['green', 0]])
+
+    def test_export_submissions(self):
+        self.record(5)
+        response = self.get(5, reverse('export_submissions',
+            args=[self.uiform.slug, 'csv']))
+        lines = response.content.splitlines()
+        self.assertEqual(lines[0], 'id,submitted,Agree,Age,Colour')
+        self.assertEqual([line.split(',', 2)[2] for line in lines[1:]],
+                ['True,%d,red' % n for n in range(5)])
+
+        response = self.get(4, reverse('export_submissions',
+            args=[self.uiform.slug, 'json']))
+        rows = [simplejson.loads(line)
+                for line in response.content.splitlines()]
+        self.assertEqual([row['answers'][str(self.fields['Age'])]
+            for row in rows], range(5))
+
+
+class AggregateTest(QueryCountTestCase):
+    def test_kind_change(self):
+        self.record(3)
+        colour = UIField.objects.get(id=self.fields['Colour'])
+        colour.kind, colour.choices = 'I', ''
+        colour.save()
+        uiform = UIForm.objects.get(id=self.uiform.id)
+        Submission.objects.record(uiform.publish(), {self.fields['Colour']: 7})
+        # From a visitor still filling out the first version
+        self.record(1)
+
+        stats = dict((field['label'], field)
+                for field in uiform.get_field_stats())
+        self.assertEqual((stats['Colour']['count'], stats['Colour']['sum']),
+                (1, 7))
+        # Choices from before the change can't be measured as integers
+        rebuild_aggregates(uiform)
+        stats = dict((field['label'], field)
+                for field in uiform.get_field_stats())
+        self.assertEqual((stats['Colour']['count'], stats['Colour']['sum']),
+                (1, 7))
+        self.assertEqual(stats['Age']['count'], 4)
+
+
+class DigestTest(QueryCountTestCase):
+    def test_send_due_digests(self):
+        UIForm.objects.filter(id=self.uiform.id).update(
+                notification_policy=NOTIFY_BATCHED)
+        url = self.token.get_absolute_url()
+        for age in range(3):
+            self.visitor.post(url, self.answers(Agree='on', Age=str(age),
+                Colour='red'))
+        self.assertEqual(PendingNotification.objects.count(), 3)
+        self.assertEqual(QueuedEmail.objects.count(), 0)
+
+        now = datetime.now()
+        self.assertEqual(send_due_digests(now), 1)
+        # Nothing is left for a second run, even once another digest is due
+        self.assertEqual(send_due_digests(now + timedelta(hours=2)), 0)
+        self.assertEqual(PendingNotification.objects.count(), 0)
+
+        self.assertEqual(deliver_queued_mail(), (1, 0))
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].subject,
+                'Your UIForm has 3 new responses!')
+        self.assertEqual(mail.outbox[0].to, ['bob@example.com'])
+
+
+class RangeFieldTest(QueryCountTestCase):
+    def test_edit_fields_checks_bounds(self):
+        self.assertRaises(ValidationError, self.uiform.edit_fields,
+                create=[{'label': 'Score', 'kind': 'R', 'minimum': 1}])
+        self.assertRaises(ValidationError, self.uiform.edit_fields,
+                update=[{'id': self.fields['Age'], 'kind': 'R'}])
+        # Nothing was changed
+        self.assertEqual([(field.label, field.kind)
+            for field in self.uiform.uifield_set.all()],
+            [('Agree', 'B'), ('Age', 'I'), ('Colour', 'C')])
+
+        self.uiform.edit_fields(update=[{'id': self.fields['Age'],
+            'kind': 'R', 'minimum': 0, 'maximum': 120}])
+        self.assertEqual(UIField.objects.get(id=self.fields['Age']).kind, 'R')
+
+    def test_missing_bound(self):
+        # Saved without the formset's checks
+        UIField.objects.create(uiform=self.uiform, label='Score', kind='R',
+                minimum=1)
+        self.uiform = UIForm.objects.get(id=self.uiform.id)
+        self.uiform.publish()
+        self.fields['Score'] = self.uiform.uifield_set.get(label='Score').id
+        url = self.token.get_absolute_url()
+        self.get(2, url, client=self.visitor)
+
+        # Everything the errors need was cached by the visit
+        response = self.post(0, url, self.answers(Agree='on', Age='42',
+            Colour='red', Score='0'), status=200, client=self.visitor)
+        self.assertContains(response, 'Enter a whole number of at least 1.')
+        self.post(11, url, self.answers(Agree='on', Age='42', Colour='red',
+            Score='1000'), client=self.visitor)
+
+
+class IngestTest(QueryCountTestCase):
+    def setUp(self):
+        super(IngestTest, self).setUp()
+        self.version = self.uiform.get_version()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def ingester(self, **options):
+        """
+        Returns a SubmissionIngester whose flusher thread won't flush by
+        itself during a test, so the test's flush() calls store everything
+        in its own transaction.
+        """
+        kwargs = {'enabled': True, 'queue_size': 100, 'batch_size': 100,
+                'interval': 60, 'put_timeout': 0}
+        kwargs.update(options)
+        return SubmissionIngester(**kwargs)
+
+    def submit(self, ingester, count):
+        for n in range(count):
+            ingester.submit(self.version, {self.fields['Agree']: True,
+                self.fields['Age']: n, self.fields['Colour']: 'red'})
+
+    def spool_files(self):
+        return [name for name in os.listdir(self.spool_dir)
+                if name.endswith(SPOOL_SUFFIX)]
+
+    def test_submit_and_flush(self):
+        ingester = self.ingester()
+        try:
+            self.submit(ingester, 3)
+            self.assertEqual(Submission.objects.count(), 0)
+            self.assertEqual(ingester.flush(), 3)
+        finally:
+            ingester.stop()
+        ages = [simplejson.loads(answers)[str(self.fields['Age'])]
+                for answers in Submission.objects.values_list('answers',
+                    flat=True)]
+        self.assertEqual(sorted(ages), [0, 1, 2])
+        stats = dict((field['label'], field)
+                for field in self.uiform.get_field_stats())
+        self.assertEqual((stats['Age']['count'], stats['Age']['sum']), (3, 3))
+
+    def test_full(self):
+        ingester = self.ingester(queue_size=2)
+        try:
+            self.submit(ingester, 2)
+            self.assertRaises(IngestFull, self.submit, ingester, 1)
+            # Room again once flushed
+            self.assertEqual(ingester.flush(), 2)
+            self.submit(ingester, 1)
+            self.assertEqual(ingester.flush(), 1)
+        finally:
+            ingester.stop()
+        self.assertEqual(Submission.objects.count(), 3)
+
+    def test_spool(self):
+        ingester = self.ingester(spool_dir=self.spool_dir)
+        try:
+            self.submit(ingester, 2)
+            names = self.spool_files()
+            self.assertEqual(len(names), 1)
+            spool = open(os.path.join(self.spool_dir, names[0]))
+            try:
+                self.assertEqual(len(spool.readlines()), 2)
+            finally:
+                spool.close()
+            self.assertEqual(ingester.flush(), 2)
+            # Removed once its submissions are committed
+            self.assertEqual(self.spool_files(), [])
+        finally:
+            ingester.stop()
+        self.assertEqual(Submission.objects.count(), 2)
+
+    def test_recover_spool(self):
+        # Left by a process that died, with a line cut short by the crash
+        now = datetime.now()
+        answers = {self.fields['Agree']: False, self.fields['Age']: 30,
+                self.fields['Colour']: 'green'}
+        spool = open(os.path.join(self.spool_dir, 'dead' + SPOOL_SUFFIX), 'w')
+        try:
+            spool.write(dump_entry(self.version.id, now, answers) +
+                    dump_entry(self.version.id + 1, now, answers) +
+                    dump_entry(self.version.id, now, answers) + '{"vers')
+        finally:
+            spool.close()
+
+        self.assertEqual(recover_spool(self.spool_dir), 2)
+        self.assertEqual(self.spool_files(), [])
+        self.assertEqual(Submission.objects.filter(version=self.version
+            ).count(), 2)
+        # The entry for a version that doesn't exist is set aside
+        rejected = open(os.path.join(self.spool_dir, REJECTED_NAME))
+        try:
+            self.assertEqual(rejected.read(), dump_entry(self.version.id + 1,
+                now, answers))
+        finally:
+            rejected.close()
+
+
+class AnnounceTest(TransactionTestCase):
+    """
+    Changes must only be announced once they've committed, or a request in
+    between could cache the old state or be woken up to read it.
+    """
+    def setUp(self):
+        reset_caches()
+        user = User.objects.create_user('bob', 'bob@example.com', 'bob')
+        self.uiform = UIForm.objects.create(label='Survey', creator=user)
+        self.field = UIField.objects.create(uiform=self.uiform, label='Age',
+                kind='I')
+
+        # Record whether each announcement was made inside a transaction
+        self.calls = []
+        def record(name):
+            def call(*args):
+                self.calls.append((name, transaction.is_managed()))
+            return call
+        token_resolver.invalidate_uiform = record('invalidate_uiform')
+        notifier.publish = record('publish')
+
+    def tearDown(self):
+        # Back to the methods
+        del token_resolver.invalidate_uiform
+        del notifier.publish
+
+    def test_publish(self):
+        self.uiform.publish()
+        self.assertEqual(self.calls, [('invalidate_uiform', False)])
+
+    def test_edit_fields(self):
+        self.uiform.edit_fields(update=[{'id': self.field.id,
+            'label': 'Years'}])
+        self.assertEqual(self.calls, [('invalidate_uiform', False),
+            ('publish', False)])
+
+
+class UIFieldViewTest(QueryCountTestCase):
+    def test_update_uifields(self):
+        url = reverse('update_uifields', args=[self.uiform.slug])
+        self.get(5, url)
+
+        fields = self.uiform.uifield_set.all()
+        data = {
+            'uifield_set-TOTAL_FORMS': len(fields) + 1,
+            'uifield_set-INITIAL_FORMS': len(fields),
+        }
+        for n, field in enumerate(fields):
+            for name in ('id', 'label', 'kind', 'description', 'choices',
+                    'minimum', 'maximum', 'position'):
+                value = getattr(field, name)
+                data['uifield_set-%d-%s' % (n, name)] = (value is not None
+                        and value or '')
+        data['uifield_set-%d-label' % len(fields)] = 'Name'
+        data['uifield_set-%d-kind' % len(fields)] = 'T'
+        self.post(15, url, data)
+        self.assertEqual(self.uiform.uifield_set.count(), 4)
+
+    def test_import_uifields(self):
+        upload = StringIO('label,kind\r\nName,T\r\nEmail,T\r\nHeight,I\r\n')
+        upload.name = 'fields.csv'
+        self.post(8, reverse('import_uifields', args=[self.uiform.slug]),
+                {'file': upload})
+        # Without replace, imported fields go after the existing ones
+        self.assertEqual([field.label for field in self.uiform.uifield_set.all()],
+                ['Agree', 'Age', 'Colour', 'Name', 'Email', 'Height'])
+
+    def test_export_uifields(self):
+        for format in ('csv', 'json'):
+            self.get(4, reverse('export_uifields',
+                args=[self.uiform.slug, format]))
+
+
+class MetricsViewTest(QueryCountTestCase):
+    def test_time_templates(self):
+        InstrumentationMiddleware()
+        render = Template.__dict__['render']
+        self.assertTrue(render.timed)
+        # Only wrapped once
+        InstrumentationMiddleware()
+        self.assertTrue(Template.__dict__['render'] is render)
+
+    def test_metrics(self):
+        staff = User.objects.create_user('staff', 'staff@example.com',
+                'staff')
+        staff.is_staff = True
+        staff.save()
+        self.client.login(username='staff', password='staff')
+        self.get(2, reverse('metrics'))
+
+
+class LoadDriverTest(TestCase):
+    def test_load_driver(self):
+        reset_caches()
+        results = LoadDriver(fields=4, seed=1).run(40)
+        self.assertEqual(sorted(results['kinds']),
+                ['preview', 'status', 'submit', 'view'])
+        for kind, stats in results['kinds'].items():
+            self.assertEqual(stats['errors'], 0, '%d of %d %s requests failed'
+                    % (stats['errors'], stats['count'], kind))
+        self.assertEqual(Submission.objects.count(),
+                results['kinds']['submit']['count'])
+
+
+class CreateRaceTest(TransactionTestCase):
+    """
+    Creates UIForms whose labels all have the same slug from several threads
+    at once. Threads each have their own connection, so this only runs
+    against a database they can share, rather than an in-memory SQLite one.
+    test_settings puts the SQLite test database in a file for it.
+    """
+    def test_create_uiform_race(self):
+        if not threads_share_database(self):
+            return
+
+        reset_caches()
+        results = CreateRace().run(threads=4, requests=40)
+        self.assertEqual(results['errors'], [])
+        self.assertEqual(results['statuses'], {302: 40})
+        self.assertEqual(results['created'], 40)
+        self.assertEqual(results['duplicate_slugs'], 0)
+
+
+class SubmitThroughputTest(TransactionTestCase):
+    """
+    Posts submissions from several threads, stored inline and then through
+    the ingester. Like CreateRaceTest, this needs a database threads share.
+    """
+    def test_submit_throughput(self):
+        if not threads_share_database(self):
+            return
+
+        reset_caches()
+        throughput = SubmitThroughput(fields=4)
+        for ingest in (False, True):
+            results = throughput.run(threads=2, requests=10, ingest=ingest)
+            self.assertEqual(results['errors'], [])
+            self.assertEqual(results['statuses'], {302: 10})
+            self.assertEqual(results['stored'], 10)
+
+
+class ReplicaRoutingTest(TransactionTestCase):
+    """
+    GETs to @use_replica views read the forms app's tables from a replica,
+    until the visitor POSTs something. Needs the replica database from
+    test_settings, and commits so the replica can see the data.
+    """
+    def setUp(self):
+        reset_caches()
+        self.user = User.objects.create_user('bob', 'bob@example.com', 'bob')
+        self.uiform = UIForm.objects.create(label='Survey', creator=self.user)
+        self.client.login(username='bob', password='bob')
+
+        # Turn replicas on, and log queries on every connection
+        self.read_databases = routers.READ_DATABASES
+        routers.READ_DATABASES = middleware.READ_DATABASES = ('replica',)
+        self.old_debug, settings.DEBUG = settings.DEBUG, True
+
+    def tearDown(self):
+        routers.READ_DATABASES = middleware.READ_DATABASES = \
+                self.read_databases
+        settings.DEBUG = self.old_debug
+
+    def tables_read(self, url):
+        """ GETs url, and returns {alias: set of the tables it read} """
+        for db in connections.all():
+            db.queries = []
+        self.assertEqual(self.client.get(url).status_code, 200)
+        return dict((db.alias, set(table for query in db.queries
+            for table in re.findall(r'FROM "(\w+)"', query['sql'])))
+            for db in connections.all())
+
+    def test_primary_after_post(self):
+        if not replica_configured(self):
+            return
+
+        url = reverse('preview_uiform', args=[self.uiform.slug])
+        tables = self.tables_read(url)
+        self.assertTrue('forms_uiform' in tables['replica'])
+        self.assertFalse('forms_uiform' in tables['default'])
+        # Sessions and users always come from the primary
+        self.assertTrue('django_session' in tables['default'])
+        self.assertFalse('django_session' in tables['replica'])
+
+        response = self.client.post(reverse('publish_uiform',
+            args=[self.uiform.slug]))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(PRIMARY_COOKIE in response.cookies)
+
+        tables = self.tables_read(url)
+        self.assertTrue('forms_uiform' in tables['default'])
+        self.assertEqual(tables['replica'], set())
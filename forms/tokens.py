@@ -0,0 +1,178 @@
+"""
+Resolves URLToken strings to their UIForms without querying the database on
+every visit to a shared form.
+
+Token to UIForm id mappings are kept in a bounded in-process LRU cache and
+in the cache backend, and UIForms themselves in the cache backend. Unknown
+tokens are cached too, for NEGATIVE_TIMEOUT seconds, and strings that can't
+be tokens at all are rejected without any lookup.
+"""
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.conf import settings
+import threading
+import time
+import re
+
+# Number of tokens kept in each process
+LRU_SIZE = getattr(settings, 'UIFORMS_TOKEN_CACHE_SIZE', 10000)
+
+# Seconds to cache known and unknown tokens for
+TIMEOUT = getattr(settings, 'UIFORMS_TOKEN_CACHE_TIMEOUT', 60 * 60)
+NEGATIVE_TIMEOUT = getattr(settings, 'UIFORMS_TOKEN_NEGATIVE_TIMEOUT', 5 * 60)
+
+# URLToken.token is always a str(uuid4())
+TOKEN_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}'
+        r'-[0-9a-f]{12}$')
+
+# Cached in place of a UIForm id for unknown tokens
+MISSING = 0
+
+def token_cache_key(token):
+    return 'uiforms:token:%s' % token
+
+def uiform_cache_key(uiform_id):
+    return 'uiforms:uiform:%d' % uiform_id
+
+
+class LRUCache(object):
+    """
+    A thread-safe, size-bounded mapping whose entries also expire. Entries
+    are kept in a circular doubly-linked list from least to most recently
+    used, so every operation takes constant time.
+    """
+    def __init__(self, size):
+        self.size = size
+        # {key: [previous link, next link, key, value, expiry]}
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, None]
+        self.lock = threading.Lock()
+
+    def _unlink(self, link):
+        previous, next = link[0], link[1]
+        previous[1] = next
+        next[0] = previous
+
+    def _append(self, link):
+        # Insert before the root, at the most recently used end
+        last = self.root[0]
+        link[0], link[1] = last, self.root
+        last[1] = link
+        self.root[0] = link
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link is None:
+                return None
+            self._unlink(link)
+            if link[4] < time.time():
+                del self.entries[key]
+                return None
+            self._append(link)
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, timeout):
+        self.lock.acquire()
+        try:
+            link = self.entries.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, value, time.time() + timeout]
+            self.entries[key] = link
+            self._append(link)
+            while len(self.entries) > self.size:
+                oldest = self.root[1]
+                self._unlink(oldest)
+                del self.entries[oldest[2]]
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            link = self.entries.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.root[:] = [self.root, self.root, None, None, None]
+        finally:
+            self.lock.release()
+
+
+class TokenResolver(object):
+    def __init__(self, size):
+        self.tokens = LRUCache(size)
+
+    def get_uiform_id(self, token):
+        """
+        Returns the id of the UIForm shared with a token, or MISSING.
+        """
+        from models import URLToken
+
+        uiform_id = self.tokens.get(token)
+        if uiform_id is None:
+            uiform_id = cache.get(token_cache_key(token))
+        if uiform_id is None:
+            # Read from the primary, as a lagging replica's answer would be
+            # cached
+            ids = URLToken.objects.using(DEFAULT_DB_ALIAS).filter(
+                    token=token).values_list('uiform', flat=True)[:1]
+            uiform_id = ids and ids[0] or MISSING
+            self.remember(token, uiform_id)
+        else:
+            self.tokens.set(token, uiform_id, self.get_timeout(uiform_id))
+        return uiform_id
+
+    def get_timeout(self, uiform_id):
+        return uiform_id == MISSING and NEGATIVE_TIMEOUT or TIMEOUT
+
+    def remember(self, token, uiform_id):
+        timeout = self.get_timeout(uiform_id)
+        self.tokens.set(token, uiform_id, timeout)
+        cache.set(token_cache_key(token), uiform_id, timeout)
+
+    def resolve(self, token):
+        """
+        Returns the UIForm shared with a token, or None if there isn't one.
+        """
+        from models import UIForm
+
+        if not TOKEN_RE.match(token):
+            return None
+
+        uiform_id = self.get_uiform_id(token)
+        if uiform_id == MISSING:
+            return None
+
+        uiform = cache.get(uiform_cache_key(uiform_id))
+        if uiform is None:
+            try:
+                uiform = UIForm.objects.using(DEFAULT_DB_ALIAS).get(
+                        id=uiform_id)
+            except UIForm.DoesNotExist:
+                # Deleted by another process since the token was cached
+                self.remember(token, MISSING)
+                return None
+            cache.set(uiform_cache_key(uiform_id), uiform, TIMEOUT)
+        return uiform
+
+    def invalidate_token(self, token):
+        self.tokens.delete(token)
+        cache.delete(token_cache_key(token))
+
+    def invalidate_uiform(self, uiform_id):
+        cache.delete(uiform_cache_key(uiform_id))
+
+
+resolver = TokenResolver(LRU_SIZE)
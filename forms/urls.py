@@ -13,6 +13,7 @@ urlpatterns = patterns('',
 
     # List of UIForms
     url(r'^$', views.list_uiforms, name='list_uiforms'),
+    url(r'^list\.json$', views.list_uiforms_json, name='list_uiforms_json'),
 
     # Create UIForm
     url(r'^create/$', views.create_uiform, name='create_uiform'),
@@ -21,6 +22,10 @@ urlpatterns = patterns('',
     url(r'^(?P<slug>[\w-]+)/update/$', views.update_uiform,
         name='update_uiform'),
 
+    # Publish the current UIFields to token visitors
+    url(r'^(?P<slug>[\w-]+)/publish/$', views.publish_uiform,
+        name='publish_uiform'),
+
     # Delete UIForm
     url(r'^(?P<slug>[\w-]+)/delete/$', views.delete_uiform,
         name='delete_uiform'),
@@ -33,16 +38,46 @@ urlpatterns = patterns('',
     url(r'^(?P<slug>[\w-]+)/fields/$', views.update_uifields, 
         name='update_uifields'),
 
+    # Import and export UIFields in bulk
+    url(r'^(?P<slug>[\w-]+)/fields/import/$', views.import_uifields,
+        name='import_uifields'),
+    url(r'^(?P<slug>[\w-]+)/fields\.(?P<format>csv|json)$',
+        views.export_uifields, name='export_uifields'),
+
     # Check UIForm status
     url(r'^(?P<id>\d+)/status/$', views.status_uiform,
         name='status_uiform'),
 
+    # Wait for a UIForm to change
+    url(r'^(?P<id>\d+)/watch/$', views.watch_uiform,
+        name='watch_uiform'),
+
+    # Check the status of many UIForms at once
+    url(r'^status/$', views.batch_status_uiforms,
+        name='batch_status_uiforms'),
+
+    # Aggregated UIForm answers
+    url(r'^(?P<id>\d+)/stats/$', views.stats_uiform,
+        name='stats_uiform'),
+
+    # Download UIForm submissions
+    url(r'^(?P<slug>[\w-]+)/submissions\.(?P<format>csv|json)$',
+        views.export_submissions, name='export_submissions'),
+
     # Share UIForm with a friend
     url(r'^(?P<slug>[\w-]+)/share/$', views.share_uiform, 
         name='share_uiform'),
 
+    # Runtime metrics for staff
+    url(r'^metrics/$', views.metrics, name='metrics'),
+
     # Preview UIForm by token and submit
     url(r'^(?P<slug>[\w-]+)/view/(?P<token>[\w-]+)/$', views.view_token_uiform,
         name='view_token_uiform'),
+
+    # Submit many responses by token
+    url(r'^(?P<slug>[\w-]+)/view/(?P<token>[\w-]+)/submissions\.'
+        r'(?P<format>csv|json)$', views.import_submissions,
+        name='import_submissions'),
 )
 
@@ -1,9 +1,35 @@
+from __future__ import with_statement
 from django.contrib import messages
-from django.template import Context
-from django.template.loader import get_template
-from django.core.mail import send_mail
+from django.template import Context, RequestContext
+from django.template.loader import get_template, render_to_string
+from django.core.cache import cache
+from django.utils.safestring import mark_safe
+from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
-from models import URLToken
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+from datetime import datetime, timedelta
+from StringIO import StringIO
+from django.db import transaction, connection
+from django.db.models import Max
+from metrics import timer
+from models import UIForm, URLToken, QueuedEmail, Submission, FieldAggregate, \
+        AggregateBucket, PendingNotification, FieldImportError, \
+        compile_preview_form, VERSION_TIMEOUT, VERSION_FIELDS_KEY, \
+        NOTIFY_IMMEDIATE
+import csv
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Delivery attempts before a queued email is marked as failed
+EMAIL_MAX_ATTEMPTS = getattr(settings, 'UIFORMS_EMAIL_MAX_ATTEMPTS', 8)
+
+# Delay in seconds before the first retry, doubled after each failure
+EMAIL_RETRY_DELAY = getattr(settings, 'UIFORMS_EMAIL_RETRY_DELAY', 60)
+
+# Most responses listed in full in a digest email
+DIGEST_MAX_RESULTS = getattr(settings, 'UIFORMS_DIGEST_MAX_RESULTS', 50)
 
 class EmailError(Exception):
     pass
@@ -25,40 +51,455 @@ def send_share_email(request, uiform, email, message):
         'message': message,
     })
 
-    try:
-        send_mail('%s has shared a UIForm with you!' % request.user.username, 
-                  email_template.render(context),
-                  settings.DEFAULT_FROM_EMAIL,
-                  [email], fail_silently=False)
-
-    except Exception, e:
-        raise EmailError(e)
+    queue_mail('%s has shared a UIForm with you!' % request.user.username, 
+               email_template.render(context),
+               settings.DEFAULT_FROM_EMAIL,
+               [email])
 
     return url
 
 
 
-def send_form_email(request, uiform, form):
+def send_form_email(request, uiform, results):
     """
     Sends an email to the creator of a UIForm with the results from someone
-    filling it out.
+    filling it out, as returned by PreviewForm.describe(). request is None
+    for submissions stored by the ingest flusher.
     """
-    email_template = get_template('uiform_completed_email.txt')
+    email_template = get_email_template('uiform_completed_email.txt')
     context = Context({
-        'user': request.user,
+        'user': request and request.user,
         'uiform': uiform,
-        'form': form,
+        'results': results,
     })
 
+    queue_mail('Your UIForm has been completed!', 
+               email_template.render(context),
+               settings.DEFAULT_FROM_EMAIL,
+               [uiform.creator.email])
+
+
+
+def notify_completed(request, uiform, results):
+    """
+    Tells the creator of a UIForm that someone filled it out, by email now
+    or in their next digest, depending on the UIForm's notification_policy.
+    Raises EmailError if the notification couldn't be saved.
+    """
+    if uiform.notification_policy == NOTIFY_IMMEDIATE:
+        return send_form_email(request, uiform, results)
+
     try:
-        send_mail('Your UIForm has been completed!', 
-                  email_template.render(context),
-                  settings.DEFAULT_FROM_EMAIL,
-                  [uiform.creator.email], fail_silently=False)
+        PendingNotification.objects.create(uiform=uiform,
+                results=simplejson.dumps(results))
     except Exception, e:
         raise EmailError(e)
 
 
+@transaction.commit_on_success
+def send_digest(uiform, now):
+    """
+    Queues one email to the creator of a UIForm with the results waiting for
+    their digest, and removes them. Returns the number of results included,
+    or 0 if another process sent this digest first.
+    """
+    pending = PendingNotification.objects.filter(uiform=uiform)
+    last_id = pending.aggregate(Max('id'))['id__max']
+    if last_id is None:
+        return 0
+
+    # Claim the digest by moving last_digest on from the value we saw
+    if not UIForm.objects.filter(id=uiform.id,
+            last_digest=uiform.last_digest).update(last_digest=now):
+        return 0
+
+    listed = [notification.get_results() for notification in
+            pending.filter(id__lte=last_id).order_by('id')[:DIGEST_MAX_RESULTS]]
+
+    # Count what's actually removed, which includes anything committed by
+    # other transactions since the results were read
+    cursor = connection.cursor()
+    cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s <= %%s' % (
+        connection.ops.quote_name(PendingNotification._meta.db_table),
+        connection.ops.quote_name('uiform_id'),
+        connection.ops.quote_name('id')), [uiform.id, last_id])
+    count = cursor.rowcount
+    transaction.set_dirty()
+
+    email_template = get_email_template('uiform_digest_email.txt')
+    context = Context({
+        'uiform': uiform,
+        'since': uiform.last_digest,
+        'count': count,
+        'submissions': listed,
+        'more': count - len(listed),
+    })
+    queue_mail('Your UIForm has %d new response%s!' % (count,
+                count != 1 and 's' or ''),
+            email_template.render(context),
+            settings.DEFAULT_FROM_EMAIL,
+            [uiform.creator.email])
+    return count
+
+
+def send_due_digests(now=None):
+    """
+    Sends a digest for each UIForm with results waiting whose notification
+    policy says it's due. Returns the number of digests sent.
+    """
+    now = now or datetime.now()
+    waiting = PendingNotification.objects.values_list('uiform',
+            flat=True).distinct()
+    sent = 0
+    for uiform in UIForm.objects.select_related('creator').filter(
+            id__in=waiting):
+        if uiform.digest_due(now) and send_digest(uiform, now):
+            sent += 1
+    return sent
+
+
+# Email templates, compiled once per process
+_email_templates = {}
+
+def get_email_template(name):
+    template = _email_templates.get(name)
+    if template is None:
+        template = _email_templates[name] = get_template(name)
+    return template
+
+
+
+def queue_mail(subject, body, from_email, recipient_list):
+    """
+    Adds an email to the outbox, to be delivered later by the
+    send_queued_email management command. Raises EmailError if the email
+    couldn't be queued.
+    """
+    try:
+        with timer('email_queue_ms'):
+            return QueuedEmail.objects.create(subject=subject, body=body,
+                    from_email=from_email, recipients=','.join(recipient_list))
+    except Exception, e:
+        raise EmailError(e)
+
+
+
+def deliver_queued_mail(batch_size=100):
+    """
+    Sends up to batch_size due emails from the outbox over a single
+    connection. Failed emails are rescheduled with exponential backoff, and
+    marked as failed after EMAIL_MAX_ATTEMPTS attempts.
+
+    Returns a (sent, deferred) tuple of counts.
+    """
+    queued = list(QueuedEmail.objects.due()[:batch_size])
+    if not queued:
+        return 0, 0
+
+    sent = deferred = 0
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception, e:
+        # Mail server is unreachable, so don't try each email separately
+        logger.warning('Could not connect to mail server: %s' % e)
+        for email in queued:
+            _defer_queued_mail(email, e)
+        return 0, len(queued)
+
+    try:
+        for email in queued:
+            message = EmailMessage(email.subject, email.body, email.from_email,
+                    email.get_recipient_list(), connection=connection)
+            try:
+                with timer('email_send_ms'):
+                    message.send()
+            except Exception, e:
+                logger.warning('Failed to send %s: %s' % (email, e))
+                _defer_queued_mail(email, e)
+                deferred += 1
+            else:
+                email.attempts += 1
+                email.sent = datetime.now()
+                email.save()
+                sent += 1
+    finally:
+        connection.close()
+
+    return sent, deferred
+
+
+def _defer_queued_mail(email, error):
+    """
+    Records a failed delivery attempt and schedules the next one.
+    """
+    email.attempts += 1
+    email.last_error = str(error)
+    if email.attempts >= EMAIL_MAX_ATTEMPTS:
+        email.failed = True
+    else:
+        delay = EMAIL_RETRY_DELAY * 2 ** (email.attempts - 1)
+        email.next_attempt = datetime.now() + timedelta(seconds=delay)
+    email.save()
+
+
+
+def iter_submission_batches(uiform, batch_size=1000):
+    """
+    Yields lists of (id, submitted, answers) tuples for every Submission of a
+    UIForm, with answers as the stored JSON string. Rows are fetched in
+    batches by id so memory use doesn't grow with the number of submissions.
+    """
+    last_id = 0
+    while True:
+        batch = list(Submission.objects.filter(uiform=uiform, id__gt=last_id)
+                .order_by('id')
+                .values_list('id', 'submitted', 'answers')[:batch_size])
+        if batch:
+            yield batch
+        if len(batch) < batch_size:
+            break
+        last_id = batch[-1][0]
+
+
+
+def iter_submissions(uiform, batch_size=1000):
+    """
+    Yields (id, submitted, answers) tuples for every Submission of a UIForm.
+    """
+    for batch in iter_submission_batches(uiform, batch_size):
+        for row in batch:
+            yield row
+
+
+
+@transaction.commit_on_success
+def rebuild_aggregates(uiform, batch_size=1000):
+    """
+    Recomputes the FieldAggregates of a UIForm from its Submissions. Each
+    batch is split into one column of answers per UIField, which is then
+    measured and reduced in one go. Answers are measured by each field's
+    current kind, and ones from before a change of kind that can't be are
+    skipped.
+    """
+    fields = dict((field.id, field)
+            for field in compile_preview_form(uiform).compiled_fields)
+    uifield_ids = set(fields)
+    totals = dict((id, [0, 0, None, None]) for id in uifield_ids)
+    histograms = dict((id, {}) for id in uifield_ids)
+
+    for batch in iter_submission_batches(uiform, batch_size):
+        columns = dict((id, []) for id in uifield_ids)
+        for id, submitted, answers in batch:
+            for uifield_id, answer in simplejson.loads(answers).items():
+                column = columns.get(int(uifield_id))
+                if column is not None and answer is not None:
+                    column.append(answer)
+
+        for uifield_id, column in columns.items():
+            if not column:
+                continue
+            measure = fields[uifield_id].measure
+            measures = []
+            for answer in column:
+                try:
+                    measures.append(measure(answer))
+                except Exception:
+                    pass
+            values = [value for value, bucket in measures if value is not None]
+            count, total, minimum, maximum = totals[uifield_id]
+            if values:
+                minimum = min(values) if minimum is None else min(minimum,
+                        min(values))
+                maximum = max(values) if maximum is None else max(maximum,
+                        max(values))
+            totals[uifield_id] = [count + len(measures), total + sum(values),
+                    minimum, maximum]
+
+            histogram = histograms[uifield_id]
+            for value, start in measures:
+                if start is not None:
+                    histogram[start] = histogram.get(start, 0) + 1
+
+    FieldAggregate.objects.filter(uifield__in=uifield_ids).delete()
+    for uifield_id, (count, total, minimum, maximum) in totals.items():
+        if not count:
+            continue
+        aggregate = FieldAggregate.objects.create(uifield_id=uifield_id,
+                kind=fields[uifield_id].kind.code, count=count, total=total,
+                minimum=minimum, maximum=maximum)
+        for start, bucket_count in histograms[uifield_id].items():
+            AggregateBucket.objects.create(aggregate=aggregate, start=start,
+                    count=bucket_count)
+
+
+
+def export_submissions_csv(uiform):
+    """
+    Generates the Submissions of a UIForm as CSV lines, with one column per
+    UIField. Answers to fields that have since been deleted are left out.
+    """
+    uifields = list(uiform.uifield_set.values_list('id', 'label'))
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+
+    def line(row):
+        writer.writerow([smart_str(value) for value in row])
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    yield line(['id', 'submitted'] + [label for id, label in uifields])
+    for id, submitted, answers in iter_submissions(uiform):
+        answers = simplejson.loads(answers)
+        yield line([id, submitted.isoformat()] +
+                [answers.get(str(field_id), '') for field_id, label in uifields])
+
+
+
+def export_submissions_json(uiform):
+    """
+    Generates the Submissions of a UIForm as JSON lines. The stored answers
+    are copied through without being decoded.
+    """
+    for id, submitted, answers in iter_submissions(uiform):
+        yield '{"id": %d, "submitted": "%s", "answers": %s}\n' % (id,
+                submitted.isoformat(), answers)
+
+
+
+def iter_submission_rows(file, format):
+    """
+    Reads responses for SubmissionManager.record_many() from a CSV file with
+    a header row, or a file with one JSON object per line such as
+    export_submissions_json() writes. Rows are read one at a time, and
+    yielded as (row number, {key: value}, error) tuples, with an error
+    message in place of the values for rows that can't be read.
+    """
+    if format == 'json':
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                row = simplejson.loads(line)
+                if not isinstance(row, dict):
+                    raise ValueError('Expected an object')
+            except ValueError, e:
+                yield number, None, 'Could not read row: %s' % e
+                continue
+
+            # Rows from export_submissions_json() keep answers separately
+            if isinstance(row.get('answers'), dict):
+                values = dict(row['answers'])
+                if 'submitted' in row:
+                    values['submitted'] = row['submitted']
+                row = values
+            yield number, row, None
+        return
+
+    reader = csv.reader(file)
+    header = None
+    while True:
+        try:
+            row = reader.next()
+            row = [value.decode('utf-8') for value in row]
+        except StopIteration:
+            break
+        except (csv.Error, UnicodeDecodeError), e:
+            yield reader.line_num, None, 'Could not read row: %s' % e
+            continue
+        if not row:
+            continue
+
+        if header is None:
+            header = row
+        elif len(row) != len(header):
+            yield reader.line_num, None, 'Expected %d columns' % len(header)
+        else:
+            yield reader.line_num, dict(zip(header, row)), None
+
+
+
+# Columns of a UIField import or export file
+FIELD_COLUMNS = ('id', 'label', 'kind', 'description', 'choices', 'minimum',
+        'maximum')
+
+def parse_field_rows(file, format):
+    """
+    Reads UIField rows for UIForm.import_fields() from a JSON or CSV file.
+    A JSON file holds a list of objects, and a CSV file has a header row.
+    Raises FieldImportError if the file can't be parsed.
+    """
+    try:
+        if format == 'json':
+            rows = simplejson.load(file)
+            if not isinstance(rows, list):
+                raise ValueError('Expected a list of fields')
+        else:
+            rows = [dict((key, value.decode('utf-8'))
+                    for key, value in row.items() if key and value is not None)
+                    for row in csv.DictReader(file)]
+    except (ValueError, csv.Error), e:
+        raise FieldImportError('Could not read %s file: %s' % (format, e))
+    if not all(isinstance(row, dict) for row in rows):
+        raise FieldImportError('Each field must be an object')
+    return rows
+
+
+
+def export_fields_csv(uiform):
+    """
+    Generates the UIFields of a UIForm as CSV lines.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELD_COLUMNS)
+    for row in uiform.export_fields():
+        writer.writerow([smart_str('' if row[column] is None else row[column])
+            for column in FIELD_COLUMNS])
+    return buffer.getvalue()
+
+
+
+def render_uiform_page(request, uiform, form, version=None):
+    """
+    Renders the page for filling out a UIForm, as shown by preview_uiform and
+    view_token_uiform. Token visitors are shown a SchemaVersion, and the
+    owner's preview shows the current fields.
+    """
+    return render_to_string('uiform_detail.html', {
+        'uiform': uiform,
+        'version': version,
+        'schema': version or uiform,
+        'form': form,
+        'fields_html': render_preview_fields(uiform, form, version),
+    }, context_instance=RequestContext(request))
+
+
+
+def render_preview_fields(uiform, form, version=None):
+    """
+    Renders the fields of a PreviewForm for uiform_detail.html. Unbound forms
+    only depend on the fields, so their HTML is cached per SchemaVersion, or
+    per last_updated timestamp for the current fields. The CSRF token is
+    outside this fragment.
+    """
+    if form.is_bound:
+        return mark_safe(render_to_string('uiform_fields.html', {'form': form}))
+
+    if version is not None:
+        key, timeout = VERSION_FIELDS_KEY % version.id, VERSION_TIMEOUT
+    else:
+        key, timeout = 'uiforms:preview_fields:%d:%s' % (uiform.id,
+                uiform.last_updated.isoformat()), None
+    html = cache.get(key)
+    if html is None:
+        html = render_to_string('uiform_fields.html', {'form': form})
+        cache.set(key, html, timeout)
+    return mark_safe(html)
+
+
 
 def result_message(success=None, failure=None, redirect=None):
     """
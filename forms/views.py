@@ -1,17 +1,36 @@
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.generic.create_update import create_object, update_object, delete_object
 from django.views.generic.list_detail import object_list, object_detail
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseGone, Http404, \
+        HttpResponseNotAllowed, HttpResponseBadRequest
 from django.shortcuts import render_to_response, get_object_or_404, redirect
 from django.template import RequestContext, Context
 from django.core.urlresolvers import reverse
 from django.contrib import messages
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+from django.views.decorators.http import condition
+from django.views.decorators.csrf import csrf_exempt
+from itertools import islice
 from uuid import uuid4
 
 import logging
 log = logging.getLogger(__name__)
 
-from models import UIForm, UIField, URLToken, UIFormForm, PreviewForm, ShareForm
+from notify import notifier, get_version, DELETED, TooManyWaiters
+from serializers import UIFormData
+from tokens import resolver as token_resolver
+from ratelimit import limit_submissions, limiter
+from routers import use_replica
+from ingest import ingester, IngestFull
+from metrics import SAMPLE_RATE, registry as metrics_registry
+from snapshots import SNAPSHOT_ROOT
+import serializers
+from models import UIForm, UIField, URLToken, Submission, UIFormForm, PreviewForm, ShareForm, \
+        FieldImportForm, SubmissionImportForm, FieldImportError, IMPORT_MAX_ROWS, \
+        IMPORT_MAX_ERRORS
 from utils import *
 
 
@@ -30,15 +49,48 @@ def landing_page(request):
 #
 ###############################################
 
+# Number of UIForms on each page of the list
+LIST_PAGE_SIZE = 25
+
+def get_uiform_page(request):
+    """
+    Returns the page of the user's UIForms after the cursor in the "after"
+    parameter, and the cursor for the next page. An invalid cursor gives the
+    first page.
+    """
+    try:
+        return UIForm.objects.page(request.user, request.GET.get('after'),
+                LIST_PAGE_SIZE)
+    except ValueError:
+        return UIForm.objects.page(request.user, size=LIST_PAGE_SIZE)
+
+
+@use_replica
 @login_required
 def list_uiforms(request):
-    options = {
-        'queryset': UIForm.objects.filter(
-            creator__username__exact=request.user.username),
-        'template_name': 'uiform_list.html',
-        'template_object_name': 'uiform',
-    }
-    return object_list(request, **options)
+    uiforms, next_cursor = get_uiform_page(request)
+    return render_to_response('uiform_list.html', {
+        'uiform_list': uiforms,
+        'next_cursor': next_cursor,
+    }, context_instance=RequestContext(request))
+
+
+@use_replica
+@login_required
+def list_uiforms_json(request):
+    uiforms, next_cursor = get_uiform_page(request)
+
+    results = []
+    for uiform in uiforms:
+        data = UIFormData.from_model(uiform, request.user.username).as_dict()
+        data['field_count'] = uiform.field_count
+        data['submission_count'] = uiform.submission_count
+        results.append(data)
+
+    return HttpResponse(simplejson.dumps({
+        'uiforms': results,
+        'next': next_cursor,
+    }), mimetype='application/json')
 
 
 @login_required
@@ -61,108 +113,340 @@ def create_uiform(request):
     }, context_instance=RequestContext(request))
 
 
+def get_owned_uiform(request, **lookup):
+    """
+    Returns the current user's UIForm matching the lookup (usually a slug or
+    an id), or raises Http404. UIForms are cached on the request, so a view
+    never loads the same one twice.
+    """
+    cached = request.__dict__.setdefault('_owned_uiforms', {})
+    key = tuple(sorted(lookup.items()))
+    if key not in cached:
+        cached[key] = get_object_or_404(
+                UIForm.objects.owned_by(request.user), **lookup)
+    return cached[key]
+
+
 @login_required
 def update_uiform(request, slug):
-    uiform = get_object_or_404(UIForm, 
-            creator__username__exact=request.user.username, slug=slug)
+    uiform = get_owned_uiform(request, slug=slug)
 
-    uifield_formset = uiform.get_field_formset()
+    if request.method == 'POST':
+        form = UIFormForm(request.POST, instance=uiform)
+        if form.is_valid():
+            form.save()
+            messages.success(request, 'UIForm updated')
+            return redirect(uiform.get_absolute_url())
+    else:
+        form = UIFormForm(instance=uiform)
 
-    options = {
-        'object_id': uiform.id,
-        'form_class': UIFormForm,
-        'template_name': 'uiform_update.html',
-        'template_object_name': 'uiform',
-        'extra_context': {
-            'formset': uifield_formset,
-        },
-    }
-    return update_object(request, **options)
+    return render_to_response('uiform_update.html', {
+        'form': form,
+        'uiform': uiform,
+        'formset': uiform.get_field_formset(),
+        'import_form': FieldImportForm(),
+    }, context_instance=RequestContext(request))
+
+
+@login_required
+def publish_uiform(request, slug):
+    uiform = get_owned_uiform(request, slug=slug)
+
+    if request.method == 'POST':
+        previous = uiform.version_id
+        version = uiform.publish()
+        if version.id == previous:
+            messages.info(request, 'Nothing has changed since version %d'
+                    % version.number)
+        else:
+            messages.success(request, 'Published version %d' % version.number)
+
+    return redirect(uiform.get_absolute_url())
 
 
 @login_required
 def delete_uiform(request, slug):
-    if not UIForm.objects.filter(
-            creator__username__exact=request.user.username, slug=slug).count():
-        log.warning('Form not found')
-        raise Http404('Form %s not found' % slug)
+    uiform = get_owned_uiform(request, slug=slug)
+
+    if request.method == 'POST':
+        uiform.delete()
+        messages.success(request, 'UIForm deleted')
+        return redirect('list_uiforms')
 
-    options = {
-        'slug': slug,
-        'model': UIForm,
-        'template_name': 'uiform_delete.html',
-        'template_object_name': 'uiform',
-        'post_delete_redirect': reverse('list_uiforms'),
-    }
-    return delete_object(request, **options)
+    return render_to_response('uiform_delete.html', {
+        'uiform': uiform,
+    }, context_instance=RequestContext(request))
 
 
+@use_replica
 @login_required
 def preview_uiform(request, slug):
     if request.method == 'POST':
         # Redirect POSTs to avoid messing with history
         return redirect('preview_uiform', slug)
 
-    options = {
-        'slug': slug,
-        'queryset': UIForm.objects.filter(
-            creator__username__exact=request.user.username),
-        'template_name': 'uiform_detail.html',
-        'template_object_name': 'uiform',
-    }
-    return object_detail(request, **options)
+    uiform = get_owned_uiform(request, slug=slug)
 
+    return HttpResponse(render_uiform_page(request, uiform,
+        uiform.get_preview_form()))
 
+
+@use_replica
+@limit_submissions
 def view_token_uiform(request, slug, token):
-    # Find the URLToken that matches both the slug and token
-    urltoken = get_object_or_404(URLToken, token=token, uiform__slug=slug)
-    uiform = urltoken.uiform
+    # Find the UIForm shared with this token, which must match the slug too.
+    # Sharing publishes a form, and forms shared before that are published
+    # by the publish_shared_uiforms command, so visits never write.
+    uiform = token_resolver.resolve(token)
+    if uiform is None or uiform.slug != slug or uiform.version_id is None:
+        raise Http404('Form %s not found' % slug)
 
     if request.method == 'POST':
 
-        # Visitor has filled out the form
-        form = uiform.get_preview_form(request.POST)
+        # Visitor has filled out the form. Check it against the compiled
+        # validators of the version they were shown, and only build a bound
+        # form to show any errors.
+        version = uiform.get_version(request.POST.get('schema_version'))
+        form_class = version.get_form_class()
+        answers, errors = form_class.validate(request.POST)
 
-        if form.is_valid():
+        if errors:
+            form = form_class(request.POST)
+            messages.error(request, 'Sorry, you need to correct some errors in the form...')
+
+        elif ingester.enabled:
+            # Buffer it to be stored and emailed in a batch, or push back on
+            # the visitor if the buffer stays full
+            try:
+                ingester.submit(version, answers)
+                messages.success(request, 'Form submitted! Nice work.')
+            except IngestFull:
+                messages.error(request, "Sorry, we're too busy to take your "
+                        "answers right now. Please try again in a moment.")
+                response = HttpResponse(render_uiform_page(request, uiform,
+                    form_class(request.POST), version), status=503)
+                response['Retry-After'] = str(int(ingester.interval) + 1)
+                return response
+
+        else:
+            Submission.objects.record(version, answers)
             try:
-                send_form_email(request, uiform, form)
+                notify_completed(request, uiform, form_class.describe(answers))
                 messages.success(request, 'Form submitted! Nice work.')
 
             except EmailError, e:
                 log.error(str(e))
                 messages.error(request, 'Error submitting form!')
 
+        if not errors:
+            if SNAPSHOT_ROOT:
+                # Skip the static snapshot so the message is shown
+                return HttpResponseRedirect('%s?submitted=1' % reverse(
+                    'view_token_uiform', args=[slug, token]))
             return redirect('view_token_uiform', slug, token)
-        else:
-            messages.error(request, 'Sorry, you need to correct some errors in the form...')
     else:
-        # Render a blank form for the visitor to fill out
-        form = uiform.get_preview_form()
+        # Render a blank form of the published version for the visitor
+        version = uiform.get_version()
+        form = version.get_form_class()()
 
-    return render_to_response('uiform_detail.html', {
-        'uiform': uiform,
-    }, context_instance=RequestContext(request))
+    # Render the same form that was validated, so its errors are shown
+    return HttpResponse(render_uiform_page(request, uiform, form, version))
+
+if SNAPSHOT_ROOT:
+    # Static snapshots of the page can't carry a CSRF token
+    view_token_uiform = csrf_exempt(view_token_uiform)
 
 
 @login_required
+@limit_submissions
+def import_submissions(request, slug, token, format):
+    """
+    Accepts a file of many responses to a shared UIForm from its creator,
+    such as ones collected offline. Up to IMPORT_MAX_ROWS valid rows are
+    stored, and the number of rows with errors is returned as JSON along
+    with the errors in the first IMPORT_MAX_ERRORS of them.
+    """
+    uiform = token_resolver.resolve(token)
+    if (uiform is None or uiform.slug != slug or uiform.version_id is None
+            or uiform.creator_id != request.user.id):
+        raise Http404('Form %s not found' % slug)
+
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    # Large uploads are spooled to disk, and read from there a row at a time
+    form = SubmissionImportForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return HttpResponseBadRequest('Upload a file of responses as "file" '
+                '(%s)' % ' '.join(form.errors.get('file', [])),
+                mimetype='text/plain')
+
+    upload = form.cleaned_data['file']
+    try:
+        rows = iter_submission_rows(upload, format)
+        stored, failed, errors = Submission.objects.record_many(
+                uiform.get_version(), islice(rows, IMPORT_MAX_ROWS),
+                max_errors=IMPORT_MAX_ERRORS)
+        # Rows past the limit are left for another upload
+        truncated = any(True for row in islice(rows, 1))
+    finally:
+        upload.close()
+
+    return HttpResponse(simplejson.dumps({
+        'stored': stored,
+        'error_count': failed,
+        'errors': [{'row': number, 'errors': row_errors}
+            for number, row_errors in errors],
+        'truncated': truncated,
+    }), mimetype='application/json')
+
+
+# Seconds a watch request waits for a change before giving up
+WATCH_TIMEOUT = getattr(settings, 'UIFORMS_WATCH_TIMEOUT', 25)
+
+# Maximum number of UIForms that can be checked in one batch status request
+STATUS_BATCH_LIMIT = 100
+
+def get_last_updated(request, ids):
+    """
+    Returns a dict of {id: last_updated} for the UIForms with the given ids
+    that belong to the current user. The result is kept on the request, so
+    the conditional GET checks and the view share a single query.
+    """
+    ids = tuple(ids)
+    cached = request.__dict__.setdefault('_uiform_last_updated', {})
+    if ids not in cached:
+        cached[ids] = dict(UIForm.objects.owned_by(request.user).filter(
+            id__in=ids).values_list('id', 'last_updated'))
+    return cached[ids]
+
+def get_status_ids(request):
+    """ Returns the valid UIForm ids requested for a batch status check """
+    ids = [int(id) for id in request.GET.getlist('id') if id.isdigit()]
+    return sorted(set(ids))[:STATUS_BATCH_LIMIT]
+
+def status_etag(request, id):
+    last_updated = get_last_updated(request, [int(id)]).get(int(id))
+    if last_updated:
+        return '%s-%s' % (id, last_updated.isoformat())
+
+def status_last_modified(request, id):
+    return get_last_updated(request, [int(id)]).get(int(id))
+
+def batch_status_etag(request):
+    last_updated = get_last_updated(request, get_status_ids(request))
+    return md5_constructor(repr(sorted(last_updated.items()))).hexdigest()
+
+def batch_status_last_modified(request):
+    last_updated = get_last_updated(request, get_status_ids(request))
+    if last_updated:
+        return max(last_updated.values())
+
+
+@use_replica
+@login_required
+@condition(etag_func=status_etag, last_modified_func=status_last_modified)
 def status_uiform(request, id):
-    uiform = get_object_or_404(UIForm, id=id,
-            creator__username__exact=request.user.username)
-    return render_to_response('uiform.json', {
-        'uiform': uiform,
-    })
-    
+    uiform = get_object_or_404(UIForm.objects.owned_by(request.user).values(
+        *UIFormData.values_fields), id=id)
+    return HttpResponse(serializers.dumps(
+        UIFormData.from_values(uiform, request.user.username)),
+        mimetype='application/json')
+
+
+@use_replica
+@login_required
+@condition(etag_func=batch_status_etag,
+        last_modified_func=batch_status_last_modified)
+def batch_status_uiforms(request):
+    """
+    Returns the status of several UIForms at once, given as id parameters.
+    Unknown ids are left out of the results.
+    """
+    uiforms = UIForm.objects.owned_by(request.user).filter(
+            id__in=get_status_ids(request)).values(*UIFormData.values_fields)
+
+    return HttpResponse(serializers.dumps([
+        UIFormData.from_values(uiform, request.user.username)
+        for uiform in uiforms]), mimetype='application/json')
+
+
+@login_required
+def watch_uiform(request, id):
+    """
+    Long-polling alternative to status_uiform. Waits until the UIForm's
+    version differs from the version parameter, then returns the new one.
+    Returns 204 if nothing changed within WATCH_TIMEOUT seconds, or at once
+    with a Retry-After header if too many requests are already waiting.
+    """
+    uiform = get_object_or_404(UIForm.objects.owned_by(request.user).only(
+        'id', 'slug', 'last_updated'), id=id)
+
+    try:
+        known = int(request.GET.get('version', ''))
+    except ValueError:
+        known = None
+
+    version = get_version(uiform)
+    if version == known:
+        try:
+            version = notifier.wait(uiform.id, known, WATCH_TIMEOUT)
+        except TooManyWaiters:
+            # Ask the client to come back when it would have been answered
+            response = HttpResponse(status=204)
+            response['Retry-After'] = str(int(WATCH_TIMEOUT))
+            return response
+        if version is None:
+            return HttpResponse(status=204)
+        if version == DELETED:
+            return HttpResponseGone()
+
+    return HttpResponse(simplejson.dumps({
+        'id': uiform.id,
+        'last_updated': version,
+        'url': reverse('preview_uiform', args=[uiform.slug]),
+    }), mimetype='application/json')
+
+
+@login_required
+def stats_uiform(request, id):
+    uiform = get_owned_uiform(request, id=id)
+    return HttpResponse(simplejson.dumps({
+        'id': uiform.id,
+        'fields': uiform.get_field_stats(),
+    }), mimetype='application/json')
+
+
+@login_required
+def export_submissions(request, slug, format):
+    uiform = get_owned_uiform(request, slug=slug)
+
+    # Stream the rows instead of building the whole export in memory
+    if format == 'csv':
+        response = HttpResponse(export_submissions_csv(uiform),
+                mimetype='text/csv')
+    else:
+        response = HttpResponse(export_submissions_json(uiform),
+                mimetype='application/x-json-lines')
+    response['Content-Disposition'] = 'attachment; filename=%s.%s' % (
+            uiform.slug, format)
+    return response
+
 
 @login_required
 def share_uiform(request, slug):
-    uiform = get_object_or_404(UIForm, slug=slug,
-            creator__username__exact=request.user.username)
+    uiform = get_owned_uiform(request, slug=slug)
 
     if request.method == 'POST':
         form = ShareForm(request.POST)
         if form.is_valid():
             log.debug('Received valid share form, creating token')
 
+            # Visitors see the fields as they were when first shared, until
+            # the UIForm is published again
+            if uiform.version_id is None:
+                uiform.publish()
+
             try:
                 url = send_share_email(request, uiform, 
                         form.cleaned_data['email'],
@@ -196,8 +480,7 @@ def share_uiform(request, slug):
 
 @login_required
 def update_uifields(request, slug):
-    uiform = get_object_or_404(UIForm, slug=slug,
-            creator__username__exact=request.user.username)
+    uiform = get_owned_uiform(request, slug=slug)
 
     if request.method == 'POST':
         formset = uiform.get_field_formset(request.POST)
@@ -212,8 +495,52 @@ def update_uifields(request, slug):
 
     return render_to_response('uiform_update.html', {
         'formset': formset,
+        'import_form': FieldImportForm(),
         'uiform': uiform,
     }, context_instance=RequestContext(request))
 
 
+@login_required
+def import_uifields(request, slug):
+    uiform = get_owned_uiform(request, slug=slug)
+
+    if request.method == 'POST':
+        form = FieldImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            format = upload.name.lower().endswith('.json') and 'json' or 'csv'
+            try:
+                rows = parse_field_rows(upload, format)
+                created, updated = uiform.import_fields(rows,
+                        replace=form.cleaned_data['replace'])
+                messages.success(request, 'Imported %d new and %d updated '
+                        'UIFields' % (created, updated))
+            except FieldImportError, e:
+                messages.error(request, 'Error importing fields: %s' % e)
+        else:
+            messages.error(request, 'Choose a JSON or CSV file to import')
+
+    return redirect(uiform.get_absolute_url())
+
 
+@login_required
+def export_uifields(request, slug, format):
+    uiform = get_owned_uiform(request, slug=slug)
+
+    if format == 'csv':
+        response = HttpResponse(export_fields_csv(uiform), mimetype='text/csv')
+    else:
+        response = HttpResponse(simplejson.dumps(uiform.export_fields()),
+                mimetype='application/json')
+    response['Content-Disposition'] = 'attachment; filename=%s-fields.%s' % (
+            uiform.slug, format)
+    return response
+
+
+@staff_member_required
+def metrics(request):
+    return HttpResponse(simplejson.dumps({
+        'sample_rate': SAMPLE_RATE,
+        'histograms': metrics_registry.snapshot(),
+        'ratelimit': limiter.metrics(),
+    }), mimetype='application/json')
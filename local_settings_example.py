@@ -18,9 +18,19 @@ DATABASES = {
         'PASSWORD': '', # Not used with sqlite3.
         'HOST': '',     # Set to empty string for localhost. Not used with sqlite3.
         'PORT': '',     # Set to empty string for default. Not used with sqlite3.
-    }
+    },
+    # Optional read replica, e.g. a copy of dev.db to try routing locally
+    # 'replica': {
+    #     'ENGINE': 'sqlite3',
+    #     'NAME': 'replica.db',
+    # },
 }
 
+# Databases that read-only views can use instead of 'default'
+UIFORMS_READ_DATABASES = ()
+# Seconds to keep a visitor's reads on 'default' after they change something
+UIFORMS_REPLICA_LAG = 10
+
 INTERNAL_IPS = ('127.0.0.1')
 
 DEFAULT_FROM_EMAIL = ''
@@ -72,8 +72,23 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'forms.middleware.InstrumentationMiddleware',
+    'forms.middleware.ReplicaMiddleware',
 )
 
+# Read-only views can read from the replicas in UIFORMS_READ_DATABASES, if
+# any are set in local_settings
+DATABASE_ROUTERS = ['forms.routers.ReplicaRouter']
+
+# Fraction of forms app requests to record timings for
+UIFORMS_METRICS_SAMPLE_RATE = 0.01
+
+# Buffer submissions to shared forms and store them in batches, spooling
+# them to files in UIFORMS_INGEST_SPOOL_DIR until they're stored. See
+# forms/ingest.py for the other settings.
+UIFORMS_INGEST_ENABLED = False
+UIFORMS_INGEST_SPOOL_DIR = None
+
 ROOT_URLCONF = 'uiforms.urls'
 
 TEMPLATE_DIRS = (
@@ -3,24 +3,25 @@
 $(document).ready(function() {
 
     console.log('preview refreshing enabled');
-    var refresh_interval = 1000;
+    var retry_interval = 5000;
 
     var id = $('#uiform-id').attr('value');
-    var status_url = $('#uiform-url').attr('value');
+    var watch_url = $('#uiform-watch-url').attr('value');
     var last_updated = parseInt($('#uiform-last-updated').attr('value'));
 
     if(typeof id == 'undefined' ||
-       typeof status_url == 'undefined') {
+       typeof watch_url == 'undefined') {
         console.error("No UIForm metadata found, can't refresh");
         return;
     }
 
-    setInterval(function() {
-        
-        // Load metadata from server as JSON
-        $.getJSON(status_url, function(status, result) {
-            // Check if UIForm has been updated
-            if(status.last_updated != last_updated) {
+    // Wait for the server to report a change, then start waiting again
+    function watch() {
+        $.ajax({url: watch_url, data: {version: last_updated},
+                dataType: 'json', cache: false,
+                success: function(status, result, xhr) {
+            // Nothing is returned if the wait timed out
+            if(status && status.last_updated != last_updated) {
                 last_updated = status.last_updated;
 
                 // Reload the form element with AJAX
@@ -28,9 +29,23 @@ $(document).ready(function() {
                 var remote_form = status.url + ' ' + form_id + '>*';
                 $(form_id).load(remote_form);
             }
-        });
 
-    }, refresh_interval);
+            // The server was too busy to wait, so come back later
+            var retry_after = parseInt(xhr.getResponseHeader('Retry-After'));
+            if(retry_after) {
+                setTimeout(watch, retry_after * 1000);
+            } else {
+                watch();
+            }
+        }, error: function(xhr) {
+            // Stop watching if the UIForm was deleted
+            if(xhr.status != 410 && xhr.status != 404) {
+                setTimeout(watch, retry_interval);
+            }
+        }});
+    }
+
+    watch();
 
 });
 
@@ -0,0 +1,20 @@
+"""
+Settings for running the tests:
+
+    ./manage.py test forms --settings=test_settings
+
+An SQLite test database is kept in a file instead of in memory, so tests
+that use several threads, each with its own connection, can share it. The
+'replica' database mirrors it, so the router tests can read from a second
+connection; UIFORMS_READ_DATABASES stays empty, and those tests turn it on.
+"""
+from settings import *
+
+if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+    DATABASES['default']['TEST_NAME'] = path.join(PROJECT_ROOT, 'test.db')
+
+# Django 1.2 only sets SUPPORTS_TRANSACTIONS on the test databases it
+# creates, and TestCase needs it for every database
+DATABASES['replica'] = dict(DATABASES['default'], TEST_MIRROR='default',
+        SUPPORTS_TRANSACTIONS=True)
+UIFORMS_READ_DATABASES = ()